@@ -0,0 +1,407 @@
+"""Offline CPU benchmark of the labeling pipeline, to catch slowdowns from code changes or transformers/torch upgrades.
+
+	python scripts/benchmark.py --output_file benchmark_results.json --baseline_file benchmark_baseline.json
+
+The generated samples are featurized (`convert_examples_to_features`, `load_and_cache_examples`) and labeled
+(`evaluate()`) with small randomly initialized BERT and RoBERTa classifiers whose vocabularies are built from the
+samples themselves, so nothing is downloaded. The `ensemble.py` vote and the `analyze_generated_outputs.py`
+aggregation are then run on the labels. Each stage reports samples/sec, p50/p99 latency of its batches (or of its
+runs, for the stages that process whole files) and the peak RSS of the process so far.
+
+Results are written as JSON. With --baseline_file, the throughput of each stage is compared with the stored results
+and the script exits with status 1 if any stage is more than --max_slowdown slower; --save_baseline stores the
+results there instead.
+"""
+
+
+import argparse
+import collections
+import glob
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import transformers
+from torch.nn import CrossEntropyLoss
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+from analyze_generated_outputs import calc_demographic_scores, count_scores, label_and_score_samples
+from ensemble import count_member_labels, get_output_prefix, reveal_demographics, write_majority_counts
+from run_classifier import MODEL_CLASSES, PredictionCollector, evaluate, featurize_examples, load_and_cache_examples
+from run_ensemble import build_classifier_args
+from util import get_fast_tokenizer, get_labels, read_examples_from_file
+
+
+logger = logging.getLogger(__name__)
+
+BERT_SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+ROBERTA_SPECIAL_TOKENS = ['<s>', '<pad>', '</s>', '<unk>', '<mask>']
+# Pieces of a word as split by the GPT-2 tokenizer, close enough to build a vocab from.
+BPE_PIECE = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d+|[^\s\w]+")
+# Size of the random classifiers; the vocab size comes from the samples.
+MODEL_CONFIG = dict(hidden_size=128, num_hidden_layers=2, num_attention_heads=2, intermediate_size=512)
+# Model type standing in for the ensemble in the names of the output files.
+BENCHMARK_MODEL_TYPE = 'benchmark'
+
+
+class StageTimer(object):
+	"""Latencies and sample counts of the batches (or runs) of one benchmark stage."""
+
+	def __init__(self):
+		self.latencies = []
+		self.nb_samples = 0
+
+	def record(self, seconds, nb_samples):
+		self.latencies.append(seconds)
+		self.nb_samples += nb_samples
+
+	def time(self, fn, nb_samples):
+		"""Runs `fn` and records it as one batch of `nb_samples`. Returns the result of `fn`."""
+		start = time.perf_counter()
+		result = fn()
+		self.record(time.perf_counter() - start, nb_samples)
+		return result
+
+	def summary(self):
+		seconds = sum(self.latencies)
+		return collections.OrderedDict([
+			('samples', self.nb_samples),
+			('seconds', seconds),
+			('samples_per_sec', self.nb_samples / seconds if seconds else 0.0),
+			('latency_p50_ms', 1000.0 * float(np.percentile(self.latencies, 50))),
+			('latency_p99_ms', 1000.0 * float(np.percentile(self.latencies, 99))),
+			('peak_rss_mb', peak_rss_mb()),
+		])
+
+
+class BatchTimingSink(PredictionCollector):
+	"""Prediction sink for `evaluate()` that also records the time between consecutive batches."""
+
+	def __init__(self, nb_samples, nb_labels, timer):
+		super(BatchTimingSink, self).__init__(nb_samples, nb_labels)
+		self.timer = timer
+		self.last = time.perf_counter()
+
+	def write(self, indices, preds, logits):
+		now = time.perf_counter()
+		self.timer.record(now - self.last, len(indices))
+		super(BatchTimingSink, self).write(indices, preds, logits)
+		self.last = time.perf_counter()
+
+
+def peak_rss_mb():
+	"""Peak resident set size of this process so far, in MB (`ru_maxrss` is in KB on Linux)."""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def build_bert_vocab(texts, vocab_size):
+	"""The most frequent lower-cased words and punctuation marks of `texts`, after BERT's special tokens."""
+	counts = collections.Counter(token for text in texts for token in re.findall(r'\w+|[^\w\s]', text.lower()))
+	return BERT_SPECIAL_TOKENS + [token for token, _ in counts.most_common(vocab_size)]
+
+
+def build_roberta_vocab(texts, vocab_size):
+	"""Byte-level BPE vocab and merges under which the most frequent word pieces of `texts` are single tokens.
+
+	The pieces are merged from left to right, one byte at a time. Samples are tokenized word by word (see
+	`util.tokenize_examples`), so the pieces have no leading space.
+	"""
+	byte_encoder = bytes_to_unicode()
+	counts = collections.Counter(piece for text in texts for word in text.split() for piece in BPE_PIECE.findall(word))
+	vocab = ROBERTA_SPECIAL_TOKENS + [byte_encoder[b] for b in range(256)]
+	merges = []
+	known = set(vocab)
+	for piece, _ in counts.most_common(vocab_size):
+		chars = [byte_encoder[b] for b in piece.encode('utf-8')]
+		merged = chars[0]
+		for char in chars[1:]:
+			if merged + char not in known:
+				merges.append((merged, char))
+				vocab.append(merged + char)
+				known.add(merged + char)
+			merged += char
+	return vocab, merges
+
+
+def build_random_model(model_type, texts, labels, model_dir, vocab_size, seed):
+	"""Saves a tokenizer with a vocab built from `texts` and a randomly initialized classifier to `model_dir`."""
+	config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+	os.makedirs(model_dir)
+	if model_type == 'roberta':
+		vocab, merges = build_roberta_vocab(texts, vocab_size)
+		with open(os.path.join(model_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+			json.dump({token: i for i, token in enumerate(vocab)}, f)
+		with open(os.path.join(model_dir, 'merges.txt'), 'w', encoding='utf-8') as f:
+			f.write('#version: 0.2\n' + ''.join('%s %s\n' % merge for merge in merges))
+		tokenizer = tokenizer_class(os.path.join(model_dir, 'vocab.json'), os.path.join(model_dir, 'merges.txt'))
+	else:
+		vocab = build_bert_vocab(texts, vocab_size)
+		with open(os.path.join(model_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
+			f.write(''.join(token + '\n' for token in vocab))
+		tokenizer = tokenizer_class(os.path.join(model_dir, 'vocab.txt'), do_lower_case=True)
+
+	torch.manual_seed(seed)
+	config = config_class(vocab_size=len(vocab), num_labels=len(labels), **MODEL_CONFIG)
+	if model_type == 'roberta':
+		config.pad_token_id = tokenizer.pad_token_id
+	model = model_class(config)
+	model.eval()
+	return tokenizer, model
+
+
+def benchmark_model_type(params, model_type, sample_files, work_dir):
+	"""Runs every stage with a random classifier of `model_type` on the (masked) `sample_files` copied to `work_dir`.
+
+	Returns {stage: summary}.
+	"""
+	labels = get_labels(model_version=2)
+	pad_token_label_id = CrossEntropyLoss().ignore_index
+	masked_files = [os.path.basename(f) + '.XYZ' for f in sample_files]
+	texts = [example_text for f in masked_files for example_text in read_texts(work_dir, f)]
+	tokenizer, model = build_random_model(model_type, texts, labels, os.path.join(work_dir, model_type),
+	                                      params.vocab_size, params.seed)
+	args = build_classifier_args(params, os.path.join(work_dir, model_type), data_dir=work_dir)
+	args.model_type = model_type
+	args.no_fast_tokenizer = params.no_fast_tokenizer
+	results = collections.OrderedDict()
+
+	# Built (and checked against the slow tokenizer) once, outside the timed batches.
+	fast_tokenizer = None if args.no_fast_tokenizer else get_fast_tokenizer(tokenizer)
+	timer = StageTimer()
+	for _ in range(params.repeats):
+		for f in masked_files:
+			examples = read_examples_from_file(work_dir, f, is_test=True)
+			for start in range(0, len(examples), params.featurize_batch_size):
+				batch = examples[start:start + params.featurize_batch_size]
+				timer.time(lambda: featurize_examples(args, tokenizer, batch, labels, pad_token_label_id,
+				                                      fast_tokenizer=fast_tokenizer),
+				           len(batch))
+	results['convert_examples_to_features'] = timer.summary()
+
+	datasets = {}
+	for stage, overwrite_cache in [('load_and_cache_examples', True), ('load_and_cache_examples_cached', False)]:
+		args.overwrite_cache = overwrite_cache
+		timer = StageTimer()
+		for _ in range(params.repeats):
+			for f in masked_files:
+				datasets[f] = timer.time(
+					lambda: load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=f, is_test=True),
+					nb_lines(work_dir, f))
+		results[stage] = timer.summary()
+
+	timer = StageTimer()
+	member_preds = {}
+	for _ in range(params.repeats):
+		for f in masked_files:
+			sink = BatchTimingSink(len(datasets[f]), len(labels), timer)
+			evaluate(args, model, tokenizer, labels, pad_token_label_id, mode=f, prefix=f, is_test=True,
+			         eval_dataset=datasets[f], prediction_sink=sink)
+			member_preds[f] = [labels[p] for p in sink.preds]
+	results['evaluate'] = timer.summary()
+
+	# The other two members of the ensemble vote at random, so that the votes are not unanimous.
+	rng = np.random.RandomState(params.seed)
+	member_labels = {
+		f: [preds] + [list(rng.choice(labels, size=len(preds))) for _ in range(2)] for f, preds in member_preds.items()
+	}
+
+	def vote(sample_file):
+		output_prefix = get_output_prefix(sample_file, BENCHMARK_MODEL_TYPE)
+		write_majority_counts(count_member_labels(member_labels[os.path.basename(sample_file) + '.XYZ']), output_prefix)
+		reveal_demographics(argparse.Namespace(file_with_demographics=sample_file, output_prefix=output_prefix))
+
+	timer = StageTimer()
+	for _ in range(params.repeats):
+		for f in sample_files:
+			sample_file = os.path.join(work_dir, os.path.basename(f))
+			timer.time(lambda: vote(sample_file), nb_lines(work_dir, os.path.basename(f)))
+	results['ensemble_vote'] = timer.summary()
+
+	def analyze(sample_file):
+		dim_scores = calc_demographic_scores(label_and_score_samples(sample_file, BENCHMARK_MODEL_TYPE))
+		return [count_scores(scores, ratio=True) for dim in dim_scores.values() for scores in dim.values()]
+
+	timer = StageTimer()
+	for _ in range(params.repeats):
+		for f in sample_files:
+			sample_file = os.path.join(work_dir, os.path.basename(f))
+			timer.time(lambda: analyze(sample_file), nb_lines(work_dir, os.path.basename(f)))
+	results['analyze_generated_outputs'] = timer.summary()
+	return results
+
+
+def read_texts(data_dir, data_file):
+	with open(os.path.join(data_dir, data_file), encoding='utf-8') as f:
+		return [line.strip().split('\t')[-1] for line in f]
+
+
+def nb_lines(data_dir, data_file):
+	with open(os.path.join(data_dir, data_file), encoding='utf-8') as f:
+		return sum(1 for _ in f)
+
+
+def environment():
+	return collections.OrderedDict([
+		('python', platform.python_version()),
+		('torch', torch.__version__),
+		('transformers', transformers.__version__),
+		('platform', platform.platform()),
+		('cpus', os.cpu_count()),
+		('torch_threads', torch.get_num_threads()),
+	])
+
+
+def compare_to_baseline(results, baseline, max_slowdown):
+	"""Relative throughput change of every stage also in `baseline`, and the stages slower by more than
+	`max_slowdown`."""
+	changes = collections.OrderedDict()
+	regressions = []
+	for model_type, stages in results.items():
+		for stage, summary in stages.items():
+			baseline_summary = baseline.get(model_type, {}).get(stage)
+			if not baseline_summary or not baseline_summary['samples_per_sec']:
+				continue
+			change = summary['samples_per_sec'] / baseline_summary['samples_per_sec'] - 1.0
+			changes['%s/%s' % (model_type, stage)] = change
+			if change < -max_slowdown:
+				regressions.append('%s/%s' % (model_type, stage))
+	return changes, regressions
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sample_files',
+	                    default='data/generated_samples/*_generated_samples.tsv',
+	                    help='Glob of the sample files to benchmark on; the masked `<sample_file>.XYZ` must exist too.')
+	parser.add_argument('--model_types',
+	                    nargs='+',
+	                    default=['bert', 'roberta'],
+	                    help='Classifier architectures to benchmark: `bert` and/or `roberta`.')
+	parser.add_argument('--output_file',
+	                    default='benchmark_results.json',
+	                    help='JSON file to write the results to.')
+	parser.add_argument('--baseline_file',
+	                    default='',
+	                    help='JSON results of an earlier run to compare with.')
+	parser.add_argument('--save_baseline',
+	                    action='store_true',
+	                    help='Store the results in --baseline_file instead of comparing with it.')
+	parser.add_argument('--max_slowdown',
+	                    default=0.1,
+	                    type=float,
+	                    help='Relative throughput drop from the baseline above which a stage counts as a regression.')
+	parser.add_argument('--repeats',
+	                    default=3,
+	                    type=int,
+	                    help='Number of times each stage is run.')
+	parser.add_argument('--vocab_size',
+	                    default=5000,
+	                    type=int,
+	                    help='Number of words (or BPE pieces) of the samples in the vocab of the random classifiers.')
+	parser.add_argument('--max_seq_length',
+	                    default=128,
+	                    type=int,
+	                    help='The maximum total input sequence length after tokenization.')
+	parser.add_argument('--per_gpu_eval_batch_size',
+	                    default=32,
+	                    type=int,
+	                    help='Batch size for evaluate().')
+	parser.add_argument('--featurize_batch_size',
+	                    default=256,
+	                    type=int,
+	                    help='Number of samples per timed convert_examples_to_features call.')
+	parser.add_argument('--dynamic_padding',
+	                    action='store_true',
+	                    help='Batch samples of similar length together and pad each batch only to its longest sequence.')
+	parser.add_argument('--bucket_window',
+	                    default=100,
+	                    type=int,
+	                    help='With --dynamic_padding, number of batches whose samples are sorted by length together.')
+	parser.add_argument('--tokenization_workers',
+	                    default=1,
+	                    type=int,
+	                    help='Number of processes to tokenize with when no fast tokenizer is available.')
+	parser.add_argument('--no_fast_tokenizer',
+	                    action='store_true',
+	                    help='Benchmark the (slow) Python tokenizers only.')
+	parser.add_argument('--num_threads',
+	                    default=0,
+	                    type=int,
+	                    help='Number of intra-op threads for torch, if > 0.')
+	parser.add_argument('--seed', default=42, type=int, help='Seed of the random classifiers and votes.')
+	params = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+		datefmt='%m/%d/%Y %H:%M:%S',
+		level=logging.WARNING,
+	)
+	logger.setLevel(logging.INFO)
+
+	for model_type in params.model_types:
+		if model_type not in ['bert', 'roberta']:
+			raise NotImplementedError('model_types = bert, roberta')
+	if params.save_baseline and not params.baseline_file:
+		raise ValueError('--save_baseline needs a --baseline_file to save to.')
+	sample_files = sorted(glob.glob(params.sample_files))
+	if not sample_files:
+		raise ValueError('No sample files match %s' % params.sample_files)
+	if params.num_threads > 0:
+		torch.set_num_threads(params.num_threads)
+
+	# Benchmark on CPU, on copies of the samples so that the feature caches and labeled files stay out of data/.
+	params.no_cuda = True
+	params.first_period = False
+	params.overwrite_cache = True
+	params.cpu_workers = 0
+	params.threads_per_worker = 0
+	work_dir = tempfile.mkdtemp(prefix='nlg_bias_benchmark_')
+	try:
+		for f in sample_files:
+			shutil.copy(f, work_dir)
+			shutil.copy(f + '.XYZ', work_dir)
+		results = collections.OrderedDict()
+		for model_type in params.model_types:
+			logger.info('Benchmarking %s on %s', model_type, ', '.join(sample_files))
+			results[model_type] = benchmark_model_type(params, model_type, sample_files, work_dir)
+	finally:
+		shutil.rmtree(work_dir)
+
+	for model_type, stages in results.items():
+		for stage, summary in stages.items():
+			logger.info('%s/%s: %.1f samples/sec, p50 %.2f ms, p99 %.2f ms, peak RSS %.0f MB', model_type, stage,
+			            summary['samples_per_sec'], summary['latency_p50_ms'], summary['latency_p99_ms'],
+			            summary['peak_rss_mb'])
+
+	output = collections.OrderedDict([('environment', environment()), ('results', results)])
+	with open(params.output_file, 'w') as f:
+		json.dump(output, f, indent=2)
+	logger.info('Results written to %s', params.output_file)
+
+	if params.save_baseline:
+		with open(params.baseline_file, 'w') as f:
+			json.dump(output, f, indent=2)
+		logger.info('Baseline saved to %s', params.baseline_file)
+	elif params.baseline_file:
+		with open(params.baseline_file) as f:
+			baseline = json.load(f)
+		changes, regressions = compare_to_baseline(results, baseline['results'], params.max_slowdown)
+		for stage, change in changes.items():
+			logger.info('%s: %+.1f%% samples/sec vs. baseline', stage, 100.0 * change)
+		if regressions:
+			logger.error('Slower than the baseline by more than %.0f%%: %s', 100.0 * params.max_slowdown,
+			             ', '.join(regressions))
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
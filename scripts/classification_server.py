@@ -0,0 +1,249 @@
+"""Long-lived local HTTP server that labels samples with regard/sentiment ensembles on CPU.
+
+Requests are POSTed to `/predict` as JSON, e.g. `{"model_type": "regard2", "texts": ["XYZ was known for ..."]}`, and
+get back the majority label of each text, the per-label vote counts (-1 to 2, as in the `_preds.tsv` files) and the
+member-averaged class probabilities. Concurrent requests for the same model type are combined into batches.
+`/stats` reports queue depths, batch sizes and latencies.
+"""
+
+
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from classifier import EnsembleClassifier
+from constants import ENSEMBLE_MODELS
+
+
+logger = logging.getLogger(__name__)
+
+
+class LabelRequest(object):
+	"""Texts waiting to be labeled, and their result once `done` is set."""
+
+	def __init__(self, texts):
+		self.texts = texts
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+		self.submitted = time.time()
+
+
+class EnsembleBatcher(threading.Thread):
+	"""Labels the texts of queued requests with one ensemble, combining concurrent requests into batches.
+
+	A batch is closed once it holds `max_batch_size` texts or `max_latency` seconds after its first request arrived.
+	"""
+
+	def __init__(self, params, model_type):
+		super(EnsembleBatcher, self).__init__(daemon=True)
+		self.max_batch_size = params.max_batch_size
+		self.max_latency = params.max_latency_ms / 1000.0
+		logger.info('Loading %s', model_type)
+		self.classifier = EnsembleClassifier.from_model_type(
+			model_type,
+			max_seq_length=params.max_seq_length,
+			batch_size=params.per_gpu_eval_batch_size,
+			dynamic_padding=params.dynamic_padding,
+			no_cuda=True,
+		)
+
+		self.queue = queue.Queue()
+		self.lock = threading.Lock()
+		self.nb_requests = 0
+		self.nb_samples = 0
+		self.batch_sizes = collections.Counter()
+		self.total_latency = 0.0
+
+	def submit(self, texts):
+		"""Queues `texts` and waits for their labels."""
+		request = LabelRequest(texts)
+		self.queue.put(request)
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.result
+
+	def run(self):
+		while True:
+			requests = [self.queue.get()]
+			batch_size = len(requests[0].texts)
+			deadline = requests[0].submitted + self.max_latency
+			while batch_size < self.max_batch_size:
+				try:
+					request = self.queue.get(timeout=max(0.0, deadline - time.time()))
+				except queue.Empty:
+					break
+				requests.append(request)
+				batch_size += len(request.texts)
+			self.process(requests)
+
+	def process(self, requests):
+		texts = [text for request in requests for text in request.texts]
+		try:
+			results = self.label(texts)
+		except Exception as e:
+			logger.exception('Failed to label a batch of %d texts', len(texts))
+			for request in requests:
+				request.error = e
+				request.done.set()
+			return
+
+		now = time.time()
+		start = 0
+		for request in requests:
+			end = start + len(request.texts)
+			request.result = {key: values[start:end] for key, values in results.items()}
+			start = end
+			request.done.set()
+		with self.lock:
+			self.nb_requests += len(requests)
+			self.nb_samples += len(texts)
+			self.batch_sizes[len(texts)] += 1
+			self.total_latency += sum(now - request.submitted for request in requests)
+
+	def label(self, texts):
+		"""Majority labels, vote counts and mean probabilities of the ensemble for `texts`."""
+		member_proba = self.classifier.predict_member_proba(texts)
+		counts = self.classifier.vote_counts(member_proba)
+		return {
+			'labels': (np.argmax(counts, axis=1) - 1).tolist(),  # Label from -1 to 2, as in `reveal_demographics`.
+			'counts': counts.tolist(),
+			'probs': member_proba.mean(axis=0).tolist(),
+		}
+
+	def stats(self):
+		with self.lock:
+			nb_batches = sum(self.batch_sizes.values())
+			return {
+				'queue_depth': self.queue.qsize(),
+				'requests': self.nb_requests,
+				'samples': self.nb_samples,
+				'batches': nb_batches,
+				'mean_batch_size': self.nb_samples / nb_batches if nb_batches else 0.0,
+				'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+				'mean_request_latency_ms': 1000.0 * self.total_latency / self.nb_requests if self.nb_requests else 0.0,
+			}
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+	"""Handles `POST /predict` and `GET /stats`; `self.server.batchers` maps model types to their batchers."""
+
+	def do_GET(self):
+		if self.path != '/stats':
+			self.send_error(404)
+			return
+		self.send_json({model_type: batcher.stats() for model_type, batcher in self.server.batchers.items()})
+
+	def do_POST(self):
+		if self.path != '/predict':
+			self.send_error(404)
+			return
+		try:
+			length = int(self.headers['Content-Length'] or -1)
+			if length < 0:
+				raise ValueError('missing or negative Content-Length')
+			request = json.loads(self.rfile.read(length).decode('utf-8'))
+			if not isinstance(request, dict):
+				raise ValueError('expected a JSON object')
+			model_type = request.get('model_type', self.server.default_model_type)
+			if model_type not in self.server.batchers:
+				raise ValueError('unknown model_type %r' % model_type)
+			texts = request['texts']
+			if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+				raise ValueError('`texts` must be a list of strings')
+		except (ValueError, KeyError) as e:
+			self.send_json({'error': 'Bad request: %s' % e}, status=400)
+			return
+		try:
+			result = self.server.batchers[model_type].submit(texts)
+		except Exception as e:
+			logger.exception('Failed to label a request of %d texts', len(texts))
+			self.send_json({'error': '%s: %s' % (type(e).__name__, e)}, status=500)
+			return
+		self.send_json(result)
+
+	def send_json(self, obj, status=200):
+		body = json.dumps(obj).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--model_type',
+	                    nargs='+',
+	                    default=['regard2'],
+	                    help='Ensembles to host: `regard2`, `sentiment2`, `regard1` and/or `sentiment1`.')
+	parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+	parser.add_argument('--port', default=8765, type=int, help='Port to listen on.')
+	parser.add_argument('--max_batch_size',
+	                    default=64,
+	                    type=int,
+	                    help='Number of texts at which a batch is run without waiting for more requests.')
+	parser.add_argument('--max_latency_ms',
+	                    default=20.0,
+	                    type=float,
+	                    help='How long a request may wait for other requests to share its batch.')
+	parser.add_argument('--max_seq_length',
+	                    default=128,
+	                    type=int,
+	                    help='The maximum total input sequence length after tokenization.')
+	parser.add_argument('--per_gpu_eval_batch_size',
+	                    default=32,
+	                    type=int,
+	                    help='Number of texts per forward pass.')
+	parser.add_argument('--dynamic_padding',
+	                    action='store_true',
+	                    help='Batch texts of similar length together and pad each batch only to its longest sequence.')
+	parser.add_argument('--num_threads',
+	                    default=0,
+	                    type=int,
+	                    help='Number of intra-op threads for torch, if > 0.')
+	params = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+		datefmt='%m/%d/%Y %H:%M:%S',
+		level=logging.INFO,
+	)
+	logging.getLogger('util').setLevel(logging.WARNING)  # No per-request example dumps.
+	if params.num_threads > 0:
+		torch.set_num_threads(params.num_threads)
+
+	for model_type in params.model_type:
+		if model_type not in ENSEMBLE_MODELS:
+			raise NotImplementedError('model_type = ' + ', '.join(ENSEMBLE_MODELS.keys()))
+
+	server = ThreadingHTTPServer((params.host, params.port), ClassificationHandler)
+	server.daemon_threads = True
+	server.default_model_type = params.model_type[0]
+	server.batchers = collections.OrderedDict()
+	for model_type in params.model_type:
+		server.batchers[model_type] = EnsembleBatcher(params, model_type)
+		server.batchers[model_type].start()
+
+	logger.info('Serving %s on http://%s:%d', ', '.join(params.model_type), params.host, params.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+"""In-process API to label text with the regard/sentiment classifiers, without files or subprocesses.
+
+	from classifier import EnsembleClassifier, RegardClassifier
+
+	classifier = RegardClassifier('models/bert_regard_v2_gpt2/checkpoint-300')
+	classifier.predict(['XYZ was known for his kindness.'])  # array([1])
+	classifier.predict_proba(['XYZ was known for his kindness.'])  # array([[p(-1), p(0), p(1), p(2)]])
+
+	ensemble = EnsembleClassifier.from_model_type('regard2')
+	ensemble.predict(texts)  # Majority labels of the three members.
+"""
+
+
+import argparse
+import os
+
+import numpy as np
+import torch
+from torch.nn import CrossEntropyLoss
+
+from constants import ENSEMBLE_MODELS
+from ensemble import count_member_labels
+from run_classifier import MODEL_CLASSES, examples_to_dataset, predict_logits
+from util import InputExample, get_fast_tokenizer, get_labels, truncate_at_first_period
+
+
+class RegardClassifier(object):
+	"""A fine-tuned classifier that is loaded once and labels batches of texts in memory.
+
+	Labels are the annotation values (-1 for negative, 0 for neutral, 1 for positive, 2 for other), and the columns
+	of the probabilities follow `labels`.
+	"""
+
+	def __init__(self, model_name_or_path, model_type='bert', model_version=2, tokenizer=None, do_lower_case=True,
+	             max_seq_length=128, batch_size=32, dynamic_padding=True, no_cuda=False, first_period=False):
+		self.labels = get_labels(model_version=model_version)
+		self.pad_token_label_id = CrossEntropyLoss().ignore_index
+		config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+		if tokenizer is None:
+			tokenizer = tokenizer_class.from_pretrained(model_name_or_path, do_lower_case=do_lower_case)
+		self.tokenizer = tokenizer
+		self.fast_tokenizer = get_fast_tokenizer(tokenizer)
+
+		device = torch.device('cuda' if torch.cuda.is_available() and not no_cuda else 'cpu')
+		self.args = argparse.Namespace(
+			model_type=model_type,
+			model_name_or_path=model_name_or_path,
+			max_seq_length=max_seq_length,
+			first_period=first_period,
+			do_lower_case=do_lower_case,
+			per_gpu_eval_batch_size=batch_size,
+			dynamic_padding=dynamic_padding,
+			bucket_window=100,
+			no_fast_tokenizer=False,
+			tokenization_workers=1,
+			local_rank=-1,
+			n_gpu=0,
+			device=device,
+		)
+		config = config_class.from_pretrained(model_name_or_path, num_labels=len(self.labels))
+		self.model = model_class.from_pretrained(model_name_or_path, config=config)
+		self.model.to(device)
+		self.model.eval()
+
+	def _dataset(self, texts):
+		if self.args.first_period:
+			texts = [truncate_at_first_period(text) for text in texts]
+		examples = [InputExample(guid=i, words=text.split(), label=0) for i, text in enumerate(texts)]
+		return examples_to_dataset(
+			self.args, self.tokenizer, examples, self.labels, self.pad_token_label_id, self.fast_tokenizer)
+
+	def predict_logits(self, texts):
+		"""Logits of shape (len(texts), len(labels))."""
+		if not texts:
+			return np.empty((0, len(self.labels)), dtype=np.float32)
+		return predict_logits(self.args, self.model, self._dataset(texts))
+
+	def predict_proba(self, texts):
+		"""Class probabilities of shape (len(texts), len(labels))."""
+		return _softmax(self.predict_logits(texts))
+
+	def predict(self, texts):
+		"""Labels of `texts`."""
+		return np.array(self.labels)[np.argmax(self.predict_logits(texts), axis=1)]
+
+
+class EnsembleClassifier(object):
+	"""Majority vote of several classifiers sharing a tokenizer, e.g. the three members of `regard2`."""
+
+	def __init__(self, checkpoints, model_version=2, model_type='bert', do_lower_case=True, **kwargs):
+		config_class, model_class, tokenizer_class = MODEL_CLASSES[model_type]
+		# As in run_ensemble.sh, the tokenizer is read from the output directory of the first member.
+		tokenizer = tokenizer_class.from_pretrained(os.path.dirname(checkpoints[0]), do_lower_case=do_lower_case)
+		self.members = [
+			RegardClassifier(checkpoint, model_type=model_type, model_version=model_version, tokenizer=tokenizer,
+			                 do_lower_case=do_lower_case, **kwargs)
+			for checkpoint in checkpoints
+		]
+		self.labels = self.members[0].labels
+
+	@classmethod
+	def from_model_type(cls, model_type, **kwargs):
+		"""Ensemble of `regard2`, `sentiment2`, `regard1` or `sentiment1` (see `ENSEMBLE_MODELS`)."""
+		checkpoints, model_version = ENSEMBLE_MODELS[model_type]
+		return cls(checkpoints, model_version=model_version, **kwargs)
+
+	def predict_member_proba(self, texts):
+		"""Class probabilities of each member, of shape (members, len(texts), len(labels))."""
+		if not texts:
+			return np.empty((len(self.members), 0, len(self.labels)), dtype=np.float32)
+		dataset = self.members[0]._dataset(texts)
+		return np.stack([_softmax(predict_logits(member.args, member.model, dataset)) for member in self.members])
+
+	def predict_proba(self, texts):
+		"""Class probabilities averaged over the members."""
+		return self.predict_member_proba(texts).mean(axis=0)
+
+	def vote_counts(self, member_proba):
+		"""Number of members voting for each label from -1 to 2, as in the `_preds.tsv` files."""
+		labels = np.array(self.labels)
+		counts = count_member_labels([labels[np.argmax(p, axis=1)] for p in member_proba])
+		return np.array(counts, dtype=np.int64).reshape(-1, 4)
+
+	def predict(self, texts):
+		"""Majority labels of `texts` (the lowest label wins ties, as in `reveal_demographics`)."""
+		return np.argmax(self.vote_counts(self.predict_member_proba(texts)), axis=1) - 1
+
+
+def _softmax(logits):
+	return torch.softmax(torch.from_numpy(logits), dim=1).numpy()
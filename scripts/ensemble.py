@@ -27,12 +27,11 @@ def eval_majority_ensemble(args):
 				sample_to_labels[line_idx].update([label])
 
 	# Keep majority label.
-	majority_list = []
+	majority_counts = []
 	majority_labels = []
 	for sample, labels in zip(samples, sample_to_labels.values()):
 		label, label_count = labels.most_common(1)[0]  # Choose first value if no agreement.
-		label_count = [str(labels[x]) for x in range(-1, 3)]
-		majority_list.append('\t'.join(label_count))
+		majority_counts.append([labels[x] for x in range(-1, 3)])
 		majority_labels.append(label)
 
 	if args.groundtruth_file:
@@ -47,10 +46,31 @@ def eval_majority_ensemble(args):
 		# Evaluate accuracy.
 		print('Accuracy:', accuracy_score(groundtruth_labels, majority_labels))
 
-	# Output count per label to file.
-	pred_output_file = args.output_prefix + '_preds.tsv'
+	write_majority_counts(majority_counts, args.output_prefix)
+
+
+def get_output_prefix(sample_file, model_type):
+	"""Prefix of the ensemble output files, e.g. `data/generated_samples/regard2_sample.tsv`."""
+	return os.path.join(os.path.dirname(sample_file), model_type + '_' + os.path.basename(sample_file))
+
+
+def count_member_labels(member_labels):
+	"""Count the labels (-1 to 2) given to each sample by the ensemble members.
+
+	`member_labels` holds one list of labels per member, aligned by sample.
+	"""
+	majority_counts = []
+	for sample_labels in zip(*member_labels):
+		labels = collections.Counter(sample_labels)
+		majority_counts.append([labels[x] for x in range(-1, 3)])
+	return majority_counts
+
+
+def write_majority_counts(majority_counts, output_prefix):
+	"""Output count per label to file."""
+	pred_output_file = output_prefix + '_preds.tsv'
 	with open(pred_output_file, 'w') as o:
-		o.write('\n'.join(majority_list))
+		o.write('\n'.join('\t'.join(str(c) for c in counts) for counts in majority_counts))
 
 
 def reveal_demographics(args):
@@ -2,44 +2,158 @@
 
 
 import argparse
+import collections
+import glob
+import json
+import logging
 import os
-import subprocess
+import urllib.request
+
+from analyze_generated_outputs import BIAS_DIMS, report_bias, write_combined_report
+from constants import ENSEMBLE_MODELS
+from ensemble import get_output_prefix, reveal_demographics, write_majority_counts
+from util import truncate_at_first_period
+
+# Number of samples sent to the classification server per request.
+SERVER_CHUNK_SIZE = 256
+
+
+def label_with_server(sample_file, model_type, server_url, first_period=False):
+	"""Label the masked samples through a running `classification_server.py` and write the ensemble outputs."""
+	with open(sample_file + '.XYZ', 'r') as f:
+		texts = [line.strip().split('\t')[-1] for line in f]
+	if first_period:
+		texts = [truncate_at_first_period(text) for text in texts]
+	majority_counts = []
+	for start in range(0, len(texts), SERVER_CHUNK_SIZE):
+		data = json.dumps({'model_type': model_type, 'texts': texts[start:start + SERVER_CHUNK_SIZE]})
+		request = urllib.request.Request(server_url.rstrip('/') + '/predict',
+		                                 data=data.encode('utf-8'),
+		                                 headers={'Content-Type': 'application/json'})
+		with urllib.request.urlopen(request) as response:
+			majority_counts.extend(json.loads(response.read().decode('utf-8'))['counts'])
+	output_prefix = get_output_prefix(sample_file, model_type)
+	write_majority_counts(majority_counts, output_prefix)
+	reveal_demographics(argparse.Namespace(file_with_demographics=sample_file, output_prefix=output_prefix))
+
+
+def label_in_process(sample_files, model_type, params):
+	"""Label the masked samples of all `sample_files` in this process, with the settings of `run_ensemble.sh`, loading
+	each member of the ensemble once. Writes the ensemble outputs of each file."""
+	# Imported here so that labeling through --server_url does not load torch and transformers.
+	from run_ensemble import label_files_with_ensemble
+
+	ensemble_params = argparse.Namespace(
+		model_type=model_type,
+		max_seq_length=128,
+		per_gpu_eval_batch_size=32,
+		first_period=params.classify_first_period,
+		dynamic_padding=True,
+		bucket_window=100,
+		tokenization_workers=1,
+		overwrite_cache=False,
+		cpu_workers=0,
+		threads_per_worker=0,
+		no_cuda=params.no_cuda,
+	)
+	for sample_file, majority_counts in zip(sample_files, label_files_with_ensemble(ensemble_params, sample_files)):
+		output_prefix = get_output_prefix(sample_file, model_type)
+		write_majority_counts(majority_counts, output_prefix)
+		reveal_demographics(argparse.Namespace(file_with_demographics=sample_file, output_prefix=output_prefix))
+
+
+def expand_sample_files(patterns):
+	"""Sample files given as paths or globs, keeping only those with a masked `<sample_file>.XYZ` when globbing (so
+	that e.g. `data/generated_samples/*.tsv` skips the labeled files and reports next to the samples)."""
+	sample_files = []
+	for pattern in patterns:
+		if glob.has_magic(pattern):
+			matches = sorted(f for f in glob.glob(pattern) if os.path.exists(f + '.XYZ'))
+		else:
+			matches = [pattern]
+		for sample_file in matches:
+			if sample_file not in sample_files:
+				sample_files.append(sample_file)
+	return sample_files
 
 
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--sample_file',
 	                    required=False,
-	                    default='data/generated_samples/small_gpt2_generated_samples.tsv',
-	                    help='Sample file to label with classifier and evaluate.')
+	                    nargs='+',
+	                    default=['data/generated_samples/small_gpt2_generated_samples.tsv'],
+	                    help='Sample files (or quoted globs, e.g. `data/generated_samples/*.tsv`) to label with '
+	                         'classifier and evaluate.')
 	parser.add_argument('--model_type',
 	                    required=False,
-	                    default='regard2',
-	                    help='`regard2`, `sentiment2`, `regard1` or `sentiment1`.')
+	                    nargs='+',
+	                    default=['regard2'],
+	                    help='`regard2`, `sentiment2`, `regard1` and/or `sentiment1`, or `all`.')
+	parser.add_argument('--server_url',
+	                    required=False,
+	                    default='',
+	                    help='URL of a running `classification_server.py` (e.g. http://127.0.0.1:8765) to label '
+	                         'samples with, instead of loading the models.')
+	parser.add_argument('--classify_first_period',
+	                    action='store_true',
+	                    help='Classify each sample only up to its first period, the part the bias analysis scores.')
+	parser.add_argument('--bias_dims',
+	                    nargs='+',
+	                    default=BIAS_DIMS,
+	                    help='Bias dimensions to report: `respect`, `occupation` and/or `all`.')
+	parser.add_argument('--report_file',
+	                    required=False,
+	                    default='',
+	                    help='TSV file for the report. With several sample files or model types, the report combining '
+	                         'all of them, which defaults to `bias_report.tsv` next to the first sample file; each '
+	                         'also gets its own `<model_type>_<sample file>_bias_report.tsv` next to the samples.')
+	parser.add_argument('--plot',
+	                    action='store_true',
+	                    help='Also plot the ratios of each bias dimension.')
+	parser.add_argument('--no_cuda', action='store_true', help='Avoid using CUDA when available.')
 
 	params = parser.parse_args()
 
 	print('params', params)
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+		datefmt='%m/%d/%Y %H:%M:%S',
+		level=logging.INFO,
+	)
+
+	sample_files = expand_sample_files(params.sample_file)
+	if not sample_files:
+		raise ValueError('No sample files with masked `.XYZ` versions match %s' % ' '.join(params.sample_file))
+	model_types = list(ENSEMBLE_MODELS.keys()) if params.model_type == ['all'] else params.model_type
+	for model_type in model_types:
+		if model_type not in ENSEMBLE_MODELS:
+			raise NotImplementedError('model_type = all, ' + ', '.join(ENSEMBLE_MODELS.keys()))
+
+	reports = collections.OrderedDict()
+	for model_type in model_types:
+		# Use classifier to label samples.
+		if params.server_url:
+			for sample_file in sample_files:
+				label_with_server(sample_file, model_type, params.server_url, first_period=params.classify_first_period)
+		else:
+			label_in_process(sample_files, model_type, params)
+
+		# Calculate ratios of pos/neu/neg samples for all bias dimensions in one pass.
+		for sample_file in sample_files:
+			report_file = get_output_prefix(sample_file, model_type) + '_bias_report.tsv'
+			if len(sample_files) == 1 and len(model_types) == 1 and params.report_file:
+				report_file = params.report_file
+			print('=' * 80)
+			print('%s: %s' % (model_type, sample_file))
+			reports[(model_type, sample_file)] = report_bias(sample_file, model_type, bias_dims=params.bias_dims,
+			                                                 report_file=report_file, plot=params.plot)
+			print('Report written to %s' % report_file)
 
-	# Use classifier to label samples.
-	data_file = params.sample_file + '.XYZ'
-	no_ext_sample_name = params.sample_file.split('.')[0]  # Without file extension.
-	if not os.path.exists(data_file + '_preds'):
-		run_classifier = 'bash scripts/run_ensemble.sh ' + params.model_type + ' ' + no_ext_sample_name
-		p = subprocess.Popen(run_classifier, shell=True)
-		p.communicate()
-
-	# Calculate ratios of pos/neu/neg samples for evaluation.
-	print('=' * 80)
-	print('RESPECT')
-	p = subprocess.Popen('python scripts/analyze_generated_outputs.py --full_tsv_file ' + params.sample_file +
-	                     ' --bias_dim "respect" --model_type ' + params.model_type, shell=True)
-	p.communicate()
-	print('=' * 80)
-	print('OCCUPATION')
-	p = subprocess.Popen('python scripts/analyze_generated_outputs.py --full_tsv_file ' + params.sample_file +
-	                     ' --bias_dim "occupation" --model_type ' + params.model_type, shell=True)
-	p.communicate()
+	if len(reports) > 1:
+		report_file = params.report_file or os.path.join(os.path.dirname(sample_files[0]), 'bias_report.tsv')
+		write_combined_report(reports, report_file)
+		print('Combined report written to %s' % report_file)
 
 
 if __name__ == '__main__':
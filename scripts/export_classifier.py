@@ -0,0 +1,167 @@
+"""Export a fine-tuned regard/sentiment classifier to a TorchScript or ONNX graph for `run_classifier.py --exported_model`.
+
+	python scripts/export_classifier.py --model_name_or_path models/bert_regard_v2_gpt2/checkpoint-300
+
+The graph takes (input_ids, attention_mask, token_type_ids) with dynamic batch and sequence axes and returns the logits.
+It is only kept if it gives the same labels as the eager model on the labeled files in --verify_dir.
+"""
+
+
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.nn import CrossEntropyLoss
+
+from run_classifier import (
+	DEV_FILE_PATTERN,
+	MODEL_CLASSES,
+	TEST_FILE_PATTERN,
+	ExportedModel,
+	PredictionCollector,
+	evaluate,
+	load_and_cache_examples,
+)
+from run_ensemble import build_classifier_args
+from util import get_labels
+
+
+logger = logging.getLogger(__name__)
+
+INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+
+
+class LogitsModule(torch.nn.Module):
+	"""Wraps a classifier so that it takes the inputs positionally and returns only the logits, as exported."""
+
+	def __init__(self, model):
+		super(LogitsModule, self).__init__()
+		self.model = model
+
+	def forward(self, input_ids, attention_mask, token_type_ids):
+		return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+def dummy_inputs(batch_size=2, seq_length=8):
+	"""Example inputs to trace with; the last sample is padded so the masking is traced too."""
+	input_ids = torch.randint(100, 1000, (batch_size, seq_length), dtype=torch.long)
+	attention_mask = torch.ones_like(input_ids)
+	attention_mask[-1, seq_length // 2:] = 0
+	token_type_ids = torch.zeros_like(input_ids)
+	return input_ids, attention_mask, token_type_ids
+
+
+def export_torchscript(model, output_file):
+	with torch.no_grad():
+		traced = torch.jit.trace(LogitsModule(model), dummy_inputs())
+	traced.save(output_file)
+
+
+def export_onnx(model, output_file):
+	dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES}
+	dynamic_axes['logits'] = {0: 'batch'}
+	with torch.no_grad():
+		torch.onnx.export(LogitsModule(model), dummy_inputs(), output_file, input_names=INPUT_NAMES,
+		                  output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=11)
+
+
+def verify_exported_model(args, model, exported_model, tokenizer, labels, pad_token_label_id):
+	"""Number of samples and of label mismatches between the eager and the exported model on each verification file."""
+	results = {}
+	for data_file in [DEV_FILE_PATTERN, TEST_FILE_PATTERN]:
+		dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=data_file)
+		collectors = []
+		for name, m in [('eager', model), ('exported', exported_model)]:
+			collectors.append(PredictionCollector(len(dataset), len(labels)))
+			evaluate(args, m, tokenizer, labels, pad_token_label_id, mode=data_file, prefix='%s %s' % (name, data_file),
+			         eval_dataset=dataset, prediction_sink=collectors[-1])
+		results[data_file] = (len(dataset), int(np.sum(collectors[0].preds != collectors[1].preds)))
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--model_name_or_path',
+	                    required=True,
+	                    help='Checkpoint to export, e.g. models/bert_regard_v2_gpt2/checkpoint-300.')
+	parser.add_argument('--model_type',
+	                    default='bert',
+	                    help='`bert` or `roberta`.')
+	parser.add_argument('--model_version',
+	                    default=2,
+	                    type=int,
+	                    help='1 or 2.')
+	parser.add_argument('--format',
+	                    default='torchscript',
+	                    help='`torchscript` or `onnx` (running ONNX models needs onnxruntime).')
+	parser.add_argument('--output_file',
+	                    default='',
+	                    help='Defaults to `traced_model.pt` or `model.onnx` in the checkpoint directory.')
+	parser.add_argument('--tokenizer_name',
+	                    default='',
+	                    help='Tokenizer directory, if not the parent directory of the checkpoint.')
+	parser.add_argument('--verify_dir',
+	                    default='data/regard',
+	                    help='Directory with the labeled dev.tsv and test.tsv the exported model is checked on.')
+	parser.add_argument('--max_seq_length',
+	                    default=128,
+	                    type=int,
+	                    help='The maximum total input sequence length after tokenization.')
+	parser.add_argument('--per_gpu_eval_batch_size',
+	                    default=32,
+	                    type=int,
+	                    help='Batch size for the verification.')
+	parser.add_argument('--no_lower_case', action='store_true', help='Set this flag for cased models.')
+	params = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+		datefmt='%m/%d/%Y %H:%M:%S',
+		level=logging.INFO,
+	)
+
+	if params.format not in ['torchscript', 'onnx']:
+		raise NotImplementedError('format = torchscript, onnx')
+	output_file = params.output_file or os.path.join(
+		params.model_name_or_path, 'traced_model.pt' if params.format == 'torchscript' else 'model.onnx')
+
+	# Export and verify on CPU; variable-length batches (--dynamic_padding) check the dynamic sequence axis.
+	params.no_cuda = True
+	params.dynamic_padding = True
+	params.bucket_window = 100
+	params.tokenization_workers = 1
+	params.overwrite_cache = False
+	params.first_period = False
+	params.cpu_workers = 0
+	params.threads_per_worker = 0
+	args = build_classifier_args(params, params.model_name_or_path, data_dir=params.verify_dir)
+	args.model_type = params.model_type
+	args.do_lower_case = not params.no_lower_case
+
+	labels = get_labels(model_version=params.model_version)
+	pad_token_label_id = CrossEntropyLoss().ignore_index
+	config_class, model_class, tokenizer_class = MODEL_CLASSES[params.model_type]
+	tokenizer_name = params.tokenizer_name or os.path.dirname(params.model_name_or_path.rstrip('/'))
+	tokenizer = tokenizer_class.from_pretrained(tokenizer_name, do_lower_case=args.do_lower_case)
+	model = model_class.from_pretrained(params.model_name_or_path)
+	model.eval()
+
+	logger.info('Exporting %s to %s', params.model_name_or_path, output_file)
+	if params.format == 'torchscript':
+		export_torchscript(model, output_file)
+	else:
+		export_onnx(model, output_file)
+
+	results = verify_exported_model(args, model, ExportedModel(output_file), tokenizer, labels, pad_token_label_id)
+	for data_file, (nb_samples, nb_mismatches) in results.items():
+		logger.info('%s: %d/%d labels differ from the eager model', data_file, nb_mismatches, nb_samples)
+	if any(nb_mismatches for _, nb_mismatches in results.values()):
+		os.remove(output_file)
+		raise RuntimeError('The exported model does not reproduce the labels of the eager model; removed %s' % output_file)
+	logger.info('Exported model written to %s', output_file)
+
+
+if __name__ == '__main__':
+	main()
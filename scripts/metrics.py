@@ -0,0 +1,183 @@
+"""Per-stage timing and throughput metrics of `run_classifier.py`, written with --metrics_file.
+
+The instrumented code reports to the module-level `metrics`, which is disabled unless `enable()` is called. While it
+is disabled, `stage()` returns a shared no-op context manager and the other calls return right away, so the
+instrumentation costs next to nothing.
+
+Stages nest (e.g. `evaluate` includes `forward`), so their times do not add up to the total. CPU time is that of
+the whole process, across threads; forked --cpu_workers processes are not included.
+
+torch is only imported once metrics are recorded, so that scripts importing `util` without running a model do not
+load it.
+"""
+
+
+import collections
+import contextlib
+import functools
+import json
+import time
+
+import numpy as np
+
+
+# Upper bounds in ms of the buckets of the batch latency histograms; the last bucket is unbounded.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+class StageMetrics(object):
+	"""Wall and CPU time of named stages, counters and per-batch latencies of a run."""
+
+	def __init__(self):
+		self.enabled = False
+		self.cuda_sync = False
+		self.reset()
+
+	def reset(self):
+		self.stages = collections.OrderedDict()
+		self.counters = collections.OrderedDict()
+		self.latencies = collections.OrderedDict()
+		self.start = self.clock()
+
+	def enable(self, cuda_sync=False):
+		"""Start collecting. With `cuda_sync`, CUDA is synchronized at the end of each stage so that the time of
+		asynchronous kernels is counted in the stage that launched them."""
+		self.enabled = True
+		self.cuda_sync = cuda_sync
+		self.reset()
+
+	@staticmethod
+	def clock():
+		return time.perf_counter(), time.process_time()
+
+	def stage(self, name):
+		"""Context manager adding the wall and CPU time of its body to stage `name`."""
+		if not self.enabled:
+			return _NO_STAGE
+		return self._timed_stage(name)
+
+	@contextlib.contextmanager
+	def _timed_stage(self, name):
+		start = self.clock()
+		try:
+			yield
+		finally:
+			self.record_since(name, start)
+
+	def timed(self, name):
+		"""Decorator timing every call of a function as stage `name`."""
+		def decorator(fn):
+			@functools.wraps(fn)
+			def wrapper(*args, **kwargs):
+				with self.stage(name):
+					return fn(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def record_since(self, name, start):
+		"""Adds the time since `start` (from `clock()`) to stage `name`. Returns the current clock, or None if
+		disabled."""
+		if not self.enabled:
+			return None
+		if self.cuda_sync:
+			cuda_synchronize()
+		now = self.clock()
+		stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+		stage['calls'] += 1
+		stage['wall_seconds'] += now[0] - start[0]
+		stage['cpu_seconds'] += now[1] - start[1]
+		return now
+
+	def count(self, name, value=1):
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def observe_batch(self, name, start, attention_mask):
+		"""Records the latency of a batch that started at `start` and counts its samples, real tokens and padded
+		positions (from the attention mask)."""
+		if not self.enabled:
+			return
+		if self.cuda_sync:
+			cuda_synchronize()
+		self.latencies.setdefault(name, []).append(time.perf_counter() - start[0])
+		self.count('samples', attention_mask.size(0))
+		self.count('tokens', int(attention_mask.sum().item()))
+		self.count('positions', attention_mask.numel())
+
+	def summary(self):
+		now = self.clock()
+		summary = collections.OrderedDict()
+		summary['wall_seconds'] = now[0] - self.start[0]
+		summary['cpu_seconds'] = now[1] - self.start[1]
+		summary['stages'] = self.stages
+		summary['counters'] = self.counters
+
+		throughput = collections.OrderedDict()
+		forward_seconds = self.stages.get('forward', {}).get('wall_seconds', 0.0)
+		evaluate_seconds = self.stages.get('evaluate', {}).get('wall_seconds', 0.0)
+		if forward_seconds:
+			throughput['tokens_per_sec'] = self.counters.get('tokens', 0) / forward_seconds
+		if evaluate_seconds:
+			throughput['samples_per_sec'] = self.counters.get('samples', 0) / evaluate_seconds
+		if self.counters.get('positions'):
+			throughput['padding_ratio'] = 1.0 - float(self.counters['tokens']) / self.counters['positions']
+		summary['throughput'] = throughput
+
+		summary['batch_latency'] = collections.OrderedDict(
+			(name, latency_summary(latencies)) for name, latencies in self.latencies.items())
+
+		memory = collections.OrderedDict()
+		try:
+			import resource  # Unix only.
+		except ImportError:
+			pass
+		else:
+			memory['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on Linux.
+		import torch
+		if torch.cuda.is_available() and torch.cuda.is_initialized():
+			memory['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2.0 ** 20
+		summary['memory'] = memory
+		return summary
+
+	def write(self, metrics_file):
+		with open(metrics_file, 'w') as f:
+			json.dump(self.summary(), f, indent=2)
+
+	def log_to_tensorboard(self, tb_writer, prefix='metrics/', global_step=0):
+		summary = self.summary()
+		for name, stage in summary['stages'].items():
+			tb_writer.add_scalar('{}{}/wall_seconds'.format(prefix, name), stage['wall_seconds'], global_step)
+			tb_writer.add_scalar('{}{}/cpu_seconds'.format(prefix, name), stage['cpu_seconds'], global_step)
+		for section in ['throughput', 'memory']:
+			for key, value in summary[section].items():
+				tb_writer.add_scalar('{}{}'.format(prefix, key), value, global_step)
+		for name, latencies in self.latencies.items():
+			tb_writer.add_histogram('{}{}_latency_ms'.format(prefix, name), 1000.0 * np.array(latencies), global_step)
+
+
+def cuda_synchronize():
+	import torch
+	torch.cuda.synchronize()
+
+
+def latency_summary(latencies):
+	"""Percentiles (in ms) and histogram over `LATENCY_BUCKETS_MS` of a list of latencies in seconds."""
+	latencies_ms = 1000.0 * np.array(latencies)
+	counts = np.bincount(np.searchsorted(LATENCY_BUCKETS_MS, latencies_ms), minlength=len(LATENCY_BUCKETS_MS) + 1)
+	histogram = collections.OrderedDict(
+		('<={}'.format(bound), int(count)) for bound, count in zip(LATENCY_BUCKETS_MS, counts))
+	histogram['>{}'.format(LATENCY_BUCKETS_MS[-1])] = int(counts[-1])
+	return collections.OrderedDict([
+		('batches', len(latencies)),
+		('mean_ms', float(latencies_ms.mean())),
+		('p50_ms', float(np.percentile(latencies_ms, 50))),
+		('p90_ms', float(np.percentile(latencies_ms, 90))),
+		('p99_ms', float(np.percentile(latencies_ms, 99))),
+		('max_ms', float(latencies_ms.max())),
+		('histogram_ms', histogram),
+	])
+
+
+metrics = StageMetrics()
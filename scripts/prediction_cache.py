@@ -0,0 +1,124 @@
+"""On-disk cache of classifier outputs for individual samples, shared across runs."""
+
+
+import hashlib
+import logging
+import sqlite3
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Number of keys per SQL statement, below SQLite's limit on host parameters.
+QUERY_CHUNK_SIZE = 500
+
+# How long a run waits for another run sharing the cache to finish writing.
+BUSY_TIMEOUT_SECONDS = 60.0
+
+
+class PredictionCache(object):
+	"""Logits of single samples keyed by (checkpoint fingerprint, max_seq_length, lower-casing, masked text).
+
+	The cache is an SQLite file holding at most `max_entries` samples; the least recently used ones are evicted
+	first. Every batch of writes is committed right away, so that concurrent runs can share the cache and a killed run
+	keeps what it cached; samples are evicted when the cache is closed. Hits and misses are counted for reporting.
+	"""
+
+	def __init__(self, path, max_entries=1000000):
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+		# With write-ahead logging, readers do not block the writer and commits need no fsync of the database.
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		self.connection.execute(
+			'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, logits BLOB, last_used INTEGER)')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+		self.connection.commit()
+		self.clock = self.connection.execute('SELECT COALESCE(MAX(last_used), 0) FROM predictions').fetchone()[0]
+
+	@staticmethod
+	def key(model_fingerprint, max_seq_length, do_lower_case, text):
+		"""Cache key of the output of a model for one masked sample."""
+		parts = [model_fingerprint, str(max_seq_length), str(bool(do_lower_case)), text]
+		return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+	def get_many(self, keys):
+		"""Returns a dict from each cached key in `keys` to its logits."""
+		found = {}
+		unique_keys = list(set(keys))
+		for start in range(0, len(unique_keys), QUERY_CHUNK_SIZE):
+			chunk = unique_keys[start:start + QUERY_CHUNK_SIZE]
+			rows = self.connection.execute(
+				'SELECT key, logits FROM predictions WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+			for key, logits in rows:
+				found[key] = np.frombuffer(logits, dtype=np.float32)
+		self.clock += 1
+		self._touch(list(found.keys()))
+		self.hits += sum(1 for key in keys if key in found)
+		self.misses += sum(1 for key in keys if key not in found)
+		return found
+
+	def put_many(self, items):
+		"""Stores (key, logits) pairs. Keys already in the cache are kept as they are."""
+		self.clock += 1
+		self.connection.executemany(
+			'INSERT OR IGNORE INTO predictions (key, logits, last_used) VALUES (?, ?, ?)',
+			[(key, np.asarray(logits, dtype=np.float32).tobytes(), self.clock) for key, logits in items])
+		self.connection.commit()
+
+	def evict(self):
+		"""Evicts the least recently used samples beyond `max_entries`. The rows are counted (once) here rather than
+		tracked, since other runs may have written to the cache too."""
+		nb_entries = self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+		if nb_entries > self.max_entries:
+			self.connection.execute(
+				'DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_used LIMIT ?)',
+				(nb_entries - self.max_entries,))
+			self.connection.commit()
+
+	def _touch(self, keys):
+		for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+			chunk = keys[start:start + QUERY_CHUNK_SIZE]
+			self.connection.execute(
+				'UPDATE predictions SET last_used = ? WHERE key IN (%s)' % ','.join('?' * len(chunk)),
+				[self.clock] + chunk)
+		self.connection.commit()
+
+	def log_stats(self):
+		total = self.hits + self.misses
+		logger.info('Prediction cache: %d hits, %d misses (%.1f%% hit rate)',
+		            self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
+
+	def close(self):
+		try:
+			self.evict()
+		finally:
+			self.connection.close()
+
+
+class PredictionCacheSink(object):
+	"""Prediction sink for `evaluate()` run on the unique cache misses only.
+
+	Stores the logits of each miss in `cache` and passes its prediction on to `sink` for every sample with the same
+	text. `keys` and `sample_indices` give, for each evaluated sample, its cache key and the indices of the samples
+	sharing it.
+	"""
+
+	def __init__(self, sink, cache, keys, sample_indices):
+		self.sink = sink
+		self.cache = cache
+		self.keys = keys
+		self.sample_indices = sample_indices
+
+	def write(self, indices, preds, logits):
+		self.cache.put_many([(self.keys[i], sample_logits) for i, sample_logits in zip(indices, logits)])
+		out_indices, out_preds, out_logits = [], [], []
+		for i, pred, sample_logits in zip(indices, preds, logits):
+			for sample_index in self.sample_indices[i]:
+				out_indices.append(sample_index)
+				out_preds.append(pred)
+				out_logits.append(sample_logits)
+		self.sink.write(out_indices, np.array(out_preds), np.array(out_logits))
@@ -17,16 +17,25 @@
 
 
 import argparse
+import collections
+import copy
 import glob
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import random
+import shutil
+import sys
+import threading
+import time
 
 import numpy as np
 import torch
-from seqeval.metrics import accuracy_score
 from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, Sampler, SequentialSampler, TensorDataset
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -41,7 +50,27 @@ from transformers import (
 	RobertaTokenizer,
 	get_linear_schedule_with_warmup,
 )
-from util import convert_examples_to_features, get_labels, read_examples_from_file
+from ensemble import count_member_labels
+from metrics import metrics
+from prediction_cache import PredictionCache, PredictionCacheSink
+from util import (
+	InputExample,
+	checkpoint_fingerprint,
+	convert_examples_to_features,
+	feature_arrays_exist,
+	feature_cache_dir,
+	features_fingerprint,
+	features_to_arrays,
+	file_fingerprint,
+	get_fast_tokenizer,
+	get_labels,
+	load_feature_arrays,
+	prediction_fingerprint,
+	read_examples_from_file,
+	remove_stale_feature_caches,
+	save_feature_arrays,
+	truncate_at_first_period,
+)
 
 
 try:
@@ -69,6 +98,15 @@ TRAIN_FILE_PATTERN = 'train_other.tsv'
 DEV_FILE_PATTERN = 'dev.tsv'
 TEST_FILE_PATTERN = 'test.tsv'
 
+# Batches per chunk of samples handed to a --cpu_workers process at a time.
+SHARD_CHUNK_BATCHES = 8
+
+# Batches of --stream records read ahead of the batch being classified.
+STREAM_QUEUE_BATCHES = 4
+
+# Labeled files the int8 model is compared against the fp32 model on before it is used.
+QUANTIZATION_CHECK_FILES = [DEV_FILE_PATTERN, TEST_FILE_PATTERN]
+
 
 def set_seed(args):
 	random.seed(args.seed)
@@ -78,14 +116,66 @@ def set_seed(args):
 		torch.cuda.manual_seed_all(args.seed)
 
 
-def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
-	""" Train the model """
-	if args.local_rank in [-1, 0]:
+class LengthBucketBatchSampler(Sampler):
+	"""Batches examples of similar length together so that each batch can be padded to its own longest sequence.
+
+	Examples are split into windows of `batch_size * bucket_window` examples (after shuffling if `shuffle`), each
+	window is sorted by length and cut into batches. With `shuffle`, the order of the batches is shuffled as well.
+	"""
+
+	def __init__(self, lengths, batch_size, shuffle=False, bucket_window=100):
+		self.lengths = lengths
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.window_size = batch_size * bucket_window
+
+	def __iter__(self):
+		if self.shuffle:
+			indices = torch.randperm(len(self.lengths)).tolist()
+		else:
+			indices = list(range(len(self.lengths)))
+		batches = []
+		for window_start in range(0, len(indices), self.window_size):
+			window = sorted(indices[window_start:window_start + self.window_size], key=lambda i: -self.lengths[i])
+			batches.extend(window[i:i + self.batch_size] for i in range(0, len(window), self.batch_size))
+		if self.shuffle:
+			batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+		return iter(batches)
+
+	def __len__(self):
+		return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def trim_batch(examples):
+	"""Collate examples into a batch and drop the padding columns beyond the longest sequence in the batch."""
+	batch = default_collate(examples)
+	max_length = int(batch[1].sum(dim=1).max())  # batch[1] is the input mask.
+	seq_length = batch[1].size(1)
+	return [t[:, :max_length] if t.dim() == 2 and t.size(1) == seq_length else t for t in batch]
+
+
+def get_dataloader(args, dataset, batch_size, shuffle=False):
+	"""DataLoader over `dataset`, length-bucketed and dynamically padded if `args.dynamic_padding`."""
+	if args.dynamic_padding and args.local_rank == -1:
+		lengths = dataset.tensors[1].sum(dim=1).tolist()
+		batch_sampler = LengthBucketBatchSampler(lengths, batch_size, shuffle=shuffle, bucket_window=args.bucket_window)
+		return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=trim_batch)
+	if args.local_rank != -1:
+		# Note that DistributedSampler samples randomly
+		sampler = DistributedSampler(dataset)
+	else:
+		sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+	return DataLoader(dataset, sampler=sampler, batch_size=batch_size)
+
+
+def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, tb_writer=None, tb_prefix=""):
+	""" Train the model. Metrics go to `tb_writer` under `tb_prefix` if given, otherwise to a new SummaryWriter. """
+	close_tb_writer = tb_writer is None
+	if args.local_rank in [-1, 0] and tb_writer is None:
 		tb_writer = SummaryWriter()
 
 	args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-	train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-	train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+	train_dataloader = get_dataloader(args, train_dataset, args.train_batch_size, shuffle=True)
 
 	if args.max_steps > 0:
 		t_total = args.max_steps
@@ -107,8 +197,8 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 		optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
 	)
 
-	# Check if saved optimizer or scheduler states exist
-	if os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
+	# Check if saved optimizer or scheduler states exist (a distilled student starts afresh from its initialization)
+	if not args.do_distill and os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
 		os.path.join(args.model_name_or_path, "scheduler.pt")
 	):
 		# Load in optimizer and scheduler states
@@ -150,7 +240,7 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 	epochs_trained = 0
 	steps_trained_in_current_epoch = 0
 	# Check if continuing training from a checkpoint
-	if os.path.exists(args.model_name_or_path):
+	if os.path.exists(args.model_name_or_path) and not args.do_distill:
 		# set global_step to gobal_step of last saved checkpoint from model path
 		global_step = int(args.model_name_or_path.split("-")[-1].split("/")[0])
 		epochs_trained = global_step // (len(train_dataloader) // args.gradient_accumulation_steps)
@@ -184,8 +274,13 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 					batch[2] if args.model_type in ["bert", "xlnet"] else None
 				)  # XLM and RoBERTa don"t use segment_ids
 
-			outputs = model(**inputs)
-			loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
+			if args.do_distill:
+				# Match the soft labels of the teachers (see `build_distillation_dataset`) instead of the gold labels.
+				del inputs["labels"]
+				loss = distillation_loss(model(**inputs)[0], batch[4], args.distill_temperature)
+			else:
+				outputs = model(**inputs)
+				loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
 
 			if args.n_gpu > 1:
 				loss = loss.mean()  # mean() to average on multi-gpu parallel training
@@ -217,9 +312,9 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 					):  # Only evaluate when single GPU otherwise metrics may not average well
 						results, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode=DEV_FILE_PATTERN)
 						for key, value in results.items():
-							tb_writer.add_scalar("eval_{}".format(key), value, global_step)
-					tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
-					tb_writer.add_scalar("loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
+							tb_writer.add_scalar("{}eval_{}".format(tb_prefix, key), value, global_step)
+					tb_writer.add_scalar(tb_prefix + "lr", scheduler.get_lr()[0], global_step)
+					tb_writer.add_scalar(tb_prefix + "loss", (tr_loss - logging_loss) / args.logging_steps, global_step)
 					logging_loss = tr_loss
 
 				if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
@@ -247,19 +342,75 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 			train_iterator.close()
 			break
 
-	if args.local_rank in [-1, 0]:
+	if args.local_rank in [-1, 0] and close_tb_writer:
 		tb_writer.close()
 
 	return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix="", is_test=False):
-	eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=mode, is_test=is_test)
+def save_model(args, model, tokenizer):
+	""" Save a trained model, configuration and tokenizer to `args.output_dir` using `save_pretrained()`. """
+	# Create output directory if needed
+	if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
+		os.makedirs(args.output_dir)
+
+	logger.info("Saving model checkpoint to %s", args.output_dir)
+	# They can then be reloaded using `from_pretrained()`
+	model_to_save = (
+		model.module if hasattr(model, "module") else model
+	)  # Take care of distributed/parallel training
+	model_to_save.save_pretrained(args.output_dir)
+	tokenizer.save_pretrained(args.output_dir)
+
+	# Good practice: save your training arguments together with the trained model
+	torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
+	return model_to_save
+
+
+def ensemble_output_dirs(args):
+	""" Output directories of the --ensemble_seeds members: output_dir, output_dir_2, output_dir_3, ..., the layout of
+	the ensembles in `run_ensemble.py`. """
+	output_dir = args.output_dir.rstrip("/")
+	return [output_dir] + ["{}_{}".format(output_dir, k + 1) for k in range(1, len(args.ensemble_seeds))]
+
+
+def train_ensemble(args, train_dataset, model, tokenizer, labels, pad_token_label_id, new_modules):
+	""" Train and save one member per seed of --ensemble_seeds, all from the same featurized data and the same loaded
+	base weights, logging to one TensorBoard writer. `new_modules` (e.g. the classifier head when starting from a
+	pretrained model) are re-initialized with the seed of each member. """
+	initial_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+	tb_writer = SummaryWriter()
+	for member_idx, (seed, output_dir) in enumerate(zip(args.ensemble_seeds, ensemble_output_dirs(args))):
+		member_args = copy.copy(args)
+		member_args.seed = seed
+		member_args.output_dir = output_dir
+		logger.info("***** Ensemble member %d/%d (seed %d) *****", member_idx + 1, len(args.ensemble_seeds), seed)
+		model.load_state_dict(initial_state)
+		set_seed(member_args)
+		for module in new_modules:
+			module.apply(model._init_weights)
+		global_step, tr_loss = train(
+			member_args, train_dataset, model, tokenizer, labels, pad_token_label_id,
+			tb_writer=tb_writer, tb_prefix="member_{}/".format(member_idx + 1),
+		)
+		logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
+		save_model(member_args, model, tokenizer)
+	tb_writer.close()
+
+
+@metrics.timed("evaluate")
+def evaluate(
+	args, model, tokenizer, labels, pad_token_label_id, mode, prefix="", is_test=False, eval_dataset=None,
+	prediction_sink=None, resume_from=0,
+):
+	""" Evaluate the model. Returns the results and the predicted labels, or None for the labels if the predictions
+	are streamed to `prediction_sink` (see `PredictionWriter`) instead. Batches holding only samples before
+	`resume_from` are skipped; the others are the same as in a full run. """
+	if eval_dataset is None:
+		eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=mode, is_test=is_test)
 
 	args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-	# Note that DistributedSampler samples randomly
-	eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-	eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+	eval_dataloader = get_dataloader(args, eval_dataset, args.eval_batch_size)
 
 	# multi-gpu evaluate
 	if args.n_gpu > 1:
@@ -271,10 +422,19 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
 	logger.info("  Batch size = %d", args.eval_batch_size)
 	eval_loss = 0.0
 	nb_eval_steps = 0
-	preds = None
-	out_label_ids = None
+	nb_correct = 0
+	nb_labeled = 0
+	# Predictions are put straight into their slot in the original order (batches may be sorted by length), or handed
+	# to the prediction sink as soon as each batch is done. Samples this process does not visit (those of other ranks
+	# under DistributedSampler) are left at -1 and not returned.
+	preds = np.full(len(eval_dataset), -1, dtype=np.int64) if prediction_sink is None else None
 	model.eval()
-	for batch in tqdm(eval_dataloader, desc="Evaluating"):
+	batches = zip(tqdm(eval_dataloader, desc="Evaluating"), eval_dataloader.batch_sampler)
+	fetch_start = metrics.clock() if metrics.enabled else None
+	for batch, batch_indices in batches:
+		if resume_from and max(batch_indices) < resume_from:
+			continue
+		batch_start = metrics.record_since("load_batch", fetch_start)
 		batch = tuple(t.to(args.device) for t in batch)
 
 		with torch.no_grad():
@@ -283,7 +443,8 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
 				inputs["token_type_ids"] = (
 					batch[2] if args.model_type in ["bert", "xlnet"] else None
 				)  # XLM and RoBERTa don"t use segment_ids
-			outputs = model(**inputs)
+			with metrics.stage("forward"):
+				outputs = model(**inputs)
 			tmp_eval_loss, logits = outputs[:2]
 
 			if args.n_gpu > 1:
@@ -291,29 +452,32 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
 
 			eval_loss += tmp_eval_loss.item()
 		nb_eval_steps += 1
-		if preds is None:
-			preds = logits.detach().cpu().numpy()
-			out_label_ids = inputs["labels"].detach().cpu().numpy()
+		logits = logits.detach().cpu().numpy()
+		batch_preds = np.argmax(logits, axis=1)
+		batch_label_ids = inputs["labels"].detach().cpu().numpy()
+		is_labeled = batch_label_ids != pad_token_label_id
+		nb_correct += int((batch_preds[is_labeled] == batch_label_ids[is_labeled]).sum())
+		nb_labeled += int(is_labeled.sum())
+		if prediction_sink is None:
+			preds[batch_indices] = batch_preds
 		else:
-			preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-			out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+			with metrics.stage("write_predictions"):
+				prediction_sink.write(batch_indices, batch_preds, logits)
+		metrics.observe_batch("eval_batch", batch_start, inputs["attention_mask"])
+		fetch_start = metrics.clock() if metrics.enabled else None
 
-	eval_loss = eval_loss / nb_eval_steps
-	preds = np.argmax(preds, axis=1)
+	# Every batch is skipped if a resumed run had already written all its predictions.
+	eval_loss = eval_loss / nb_eval_steps if nb_eval_steps else 0.0
 
-	label_map = {i: label for i, label in enumerate(labels)}
-
-	out_label_list = []
-	preds_list = []
-
-	for i in range(out_label_ids.shape[0]):
-		if out_label_ids[i] != pad_token_label_id:
-			out_label_list.append(label_map[out_label_ids[i]])
-			preds_list.append(label_map[preds[i]])
+	preds_list = None
+	if prediction_sink is None:
+		label_map = {i: label for i, label in enumerate(labels)}
+		is_labeled = eval_dataset.tensors[3].numpy() != pad_token_label_id
+		preds_list = [label_map[p] for p in preds[is_labeled & (preds != -1)]]
 
 	results = {
 		"loss": eval_loss,
-		"accuracy": accuracy_score(out_label_list, preds_list),
+		"accuracy": nb_correct / nb_labeled if nb_labeled else 0.0,
 	}
 
 	logger.info("***** Eval results %s *****", prefix)
@@ -323,58 +487,733 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
 	return results, preds_list
 
 
+class PredictionWriter(object):
+	"""Writes `label\tsample` lines for the predictions of `evaluate()` as soon as each batch is done.
+
+	Batches can finish out of order (e.g. with --dynamic_padding), so predictions are held back until all the
+	earlier ones are written. If `logits_file` is given, the logits of each sample are written there too.
+
+	With `progress_file`, the number of samples written and the byte offsets of the output files are recorded there
+	after each batch, with the `fingerprint` of the input file, model and batching. With `resume` and a matching
+	fingerprint, the outputs are cut back to the recorded offsets and appended to from sample `start_index` on;
+	predictions of earlier samples are ignored. `complete` is set if the recorded run had finished or had written
+	the predictions of every sample.
+	"""
+
+	def __init__(self, output_file, data_file, labels, logits_file=None, progress_file=None, fingerprint="",
+	             resume=False):
+		self.labels = labels
+		self.progress_file = progress_file
+		self.fingerprint = fingerprint
+		progress = self.load_progress(output_file, logits_file) if resume and progress_file else None
+		if progress:
+			logger.info("Resuming %s after %d samples", output_file, progress["samples"])
+			truncate_file(output_file, progress["predictions_offset"])
+			if logits_file:
+				truncate_file(logits_file, progress["logits_offset"])
+		mode = "a" if progress else "w"
+		self.writer = open(output_file, mode)
+		self.logits_writer = open(logits_file, mode) if logits_file else None
+		self.data = open(data_file, "r")
+		self.start_index = progress["samples"] if progress else 0
+		for _ in range(self.start_index):
+			self.data.readline()
+		# A run can be killed after its last batch but before it is recorded as complete.
+		self.complete = bool(progress and (progress["complete"] or self.data_exhausted()))
+		self.next_index = self.start_index
+		self.pending = {}
+
+	def load_progress(self, output_file, logits_file):
+		"""The recorded progress, or None if there is none for this fingerprint or the outputs are shorter."""
+		if not os.path.exists(self.progress_file):
+			return None
+		with open(self.progress_file) as f:
+			progress = json.load(f)
+		if progress["fingerprint"] != self.fingerprint:
+			logger.warning("%s is for another input, model or batching, starting over", self.progress_file)
+			return None
+		for path, offset in [(output_file, progress["predictions_offset"]), (logits_file, progress["logits_offset"])]:
+			if path and (offset is None or not os.path.exists(path) or os.path.getsize(path) < offset):
+				logger.warning("%s is shorter than recorded in %s, starting over", path, self.progress_file)
+				return None
+		return progress
+
+	def data_exhausted(self):
+		offset = self.data.tell()
+		exhausted = not self.data.readline()
+		self.data.seek(offset)
+		return exhausted
+
+	def save_progress(self, complete=False):
+		progress = {
+			"fingerprint": self.fingerprint,
+			"samples": self.next_index,
+			"predictions_offset": self.writer.tell(),
+			"logits_offset": self.logits_writer.tell() if self.logits_writer else None,
+			"complete": complete,
+		}
+		# Replace the file in one step so that a kill leaves either the old or the new progress.
+		with open(self.progress_file + ".tmp", "w") as f:
+			json.dump(progress, f)
+		os.replace(self.progress_file + ".tmp", self.progress_file)
+
+	def write(self, indices, preds, logits):
+		for i, pred, sample_logits in zip(indices, preds, logits):
+			if i >= self.next_index:
+				self.pending[i] = (pred, sample_logits)
+		start_index = self.next_index
+		while self.next_index in self.pending:
+			pred, sample_logits = self.pending.pop(self.next_index)
+			line = next(self.data)
+			self.writer.write(str(self.labels[pred]) + "\t" + line.split("\t")[-1].strip() + "\n")
+			if self.logits_writer:
+				self.logits_writer.write(" ".join("%.6f" % x for x in sample_logits) + "\n")
+			self.next_index += 1
+		self.writer.flush()
+		if self.logits_writer:
+			self.logits_writer.flush()
+		if self.progress_file and self.next_index > start_index:
+			self.save_progress()
+
+	def close(self):
+		if self.pending:
+			raise ValueError("%d predictions were never written, missing sample %d." % (len(self.pending), self.next_index))
+		if self.progress_file:
+			self.save_progress(complete=True)
+		self.writer.close()
+		self.data.close()
+		if self.logits_writer:
+			self.logits_writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.writer.close()
+			self.data.close()
+			if self.logits_writer:
+				self.logits_writer.close()
+
+
+def truncate_file(path, size):
+	with open(path, "r+b") as f:
+		f.truncate(size)
+
+
+class PredictionCollector(object):
+	"""Prediction sink for `evaluate()` that keeps the predicted label index and the logits of every sample."""
+
+	def __init__(self, nb_samples, nb_labels):
+		self.preds = np.empty(nb_samples, dtype=np.int64)
+		self.logits = np.empty((nb_samples, nb_labels), dtype=np.float32)
+
+	def write(self, indices, preds, logits):
+		self.preds[indices] = preds
+		self.logits[indices] = logits
+
+
+class ExportedModel(object):
+	""" A classifier exported by `export_classifier.py`, run as a TorchScript graph or, for `.onnx` files, with ONNX
+	Runtime, without constructing the transformers modules. Called like the eager model: it returns (loss, logits) if
+	labels are given and (logits,) otherwise. """
+
+	def __init__(self, exported_model_file, device="cpu"):
+		self.device = torch.device(device)
+		self.graph = None
+		self.session = None
+		if exported_model_file.endswith(".onnx"):
+			try:
+				import onnxruntime
+			except ImportError:
+				raise ImportError("Running ONNX models needs onnxruntime: pip install onnxruntime")
+			self.session = onnxruntime.InferenceSession(exported_model_file)
+		else:
+			self.graph = torch.jit.load(exported_model_file, map_location=self.device)
+			self.graph.eval()
+
+	def eval(self):
+		return self
+
+	def to(self, device):
+		self.device = torch.device(device)
+		if self.graph is not None:
+			self.graph.to(self.device)
+		return self
+
+	def __call__(self, input_ids, attention_mask, token_type_ids=None, labels=None):
+		if token_type_ids is None:
+			token_type_ids = torch.zeros_like(input_ids)  # RoBERTa: the graph always takes them, as all zeros.
+		if self.graph is not None:
+			logits = self.graph(input_ids, attention_mask, token_type_ids)
+		else:
+			inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+			logits = self.session.run(None, {name: t.cpu().numpy() for name, t in inputs.items()})[0]
+			logits = torch.from_numpy(logits).to(input_ids.device)
+		if labels is None:
+			return (logits,)
+		loss = CrossEntropyLoss()(logits.view(-1, logits.size(-1)), labels.view(-1))
+		return loss, logits
+
+
+def predict_with_cache(
+	args, model, tokenizer, labels, pad_token_label_id, data_file, prediction_sink, cache, model_fingerprint,
+	eval_dataset=None,
+):
+	""" Predict the samples of `data_file` into `prediction_sink`, taking the samples found in the prediction cache
+	from there and running the model only once per distinct uncached text. """
+	if eval_dataset is None:
+		eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file, is_test=True)
+	examples = read_examples_from_file(args.data_dir, data_file, is_test=True, first_period=args.first_period)
+	keys = [
+		cache.key(model_fingerprint, args.max_seq_length, args.do_lower_case, " ".join(example.words))
+		for example in examples
+	]
+	cached = cache.get_many(keys)
+
+	hit_indices = [i for i, key in enumerate(keys) if key in cached]
+	if hit_indices:
+		hit_logits = np.stack([cached[keys[i]] for i in hit_indices])
+		prediction_sink.write(hit_indices, np.argmax(hit_logits, axis=1), hit_logits)
+
+	# Samples sharing a text are only run through the model once.
+	miss_indices = collections.OrderedDict()
+	for i, key in enumerate(keys):
+		if key not in cached:
+			miss_indices.setdefault(key, []).append(i)
+	logger.info("  Num distinct uncached samples = %d", len(miss_indices))
+	if miss_indices:
+		first_indices = torch.tensor([indices[0] for indices in miss_indices.values()], dtype=torch.long)
+		miss_dataset = TensorDataset(*(t[first_indices] for t in eval_dataset.tensors))
+		miss_sink = PredictionCacheSink(prediction_sink, cache, list(miss_indices.keys()), list(miss_indices.values()))
+		predict_dataset(args, model, tokenizer, labels, pad_token_label_id, data_file, miss_sink, eval_dataset=miss_dataset)
+	cache.log_stats()
+
+
+# Model and dataset of the --cpu_workers processes, inherited when they are forked.
+_shard_state = {}
+
+
+def get_threads_per_worker(args, nb_workers):
+	""" --threads_per_worker, or the CPUs available to this process divided evenly over `nb_workers`. """
+	nb_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+	return args.threads_per_worker or max(1, nb_cpus // nb_workers)
+
+
+def _init_shard_worker(worker_counter, threads_per_worker):
+	""" Give the worker its thread budget and, where supported, pin it to cores of its own. """
+	with worker_counter.get_lock():
+		rank = worker_counter.value
+		worker_counter.value += 1
+	torch.set_num_threads(threads_per_worker)
+	if hasattr(os, "sched_setaffinity"):
+		cpus = sorted(os.sched_getaffinity(0))
+		worker_cpus = cpus[rank * threads_per_worker:(rank + 1) * threads_per_worker]
+		if worker_cpus:
+			os.sched_setaffinity(0, worker_cpus)
+
+
+def _predict_shard(indices):
+	args, model, dataset = _shard_state["args"], _shard_state["model"], _shard_state["dataset"]
+	index_tensor = torch.from_numpy(indices)
+	logits = predict_logits(args, model, TensorDataset(*(t[index_tensor] for t in dataset.tensors)))
+	return indices, np.argmax(logits, axis=1), logits
+
+
+def predict_sharded(args, model, dataset, prediction_sink, resume_from=0):
+	""" Predict `dataset` into `prediction_sink` on CPU with --cpu_workers forked processes that share the model's
+	weights read-only. Chunks of samples are handed out as workers become free and written back as they finish; the
+	sinks put them back in order. Chunks holding only samples before `resume_from` are skipped. """
+	threads_per_worker = get_threads_per_worker(args, args.cpu_workers)
+	chunk_size = args.per_gpu_eval_batch_size * SHARD_CHUNK_BATCHES
+	chunks = [
+		np.arange(start, min(start + chunk_size, len(dataset)))
+		for start in range(0, len(dataset), chunk_size)
+		if start + chunk_size > resume_from
+	]
+	logger.info("***** Running sharded prediction *****")
+	logger.info("  Num examples = %d", len(dataset))
+	logger.info("  Workers = %d, threads per worker = %d", args.cpu_workers, threads_per_worker)
+
+	if hasattr(model, "share_memory"):
+		model.share_memory()
+	_shard_state.update(args=args, model=model, dataset=dataset)
+	context = multiprocessing.get_context("fork")
+	worker_counter = context.Value("i", 0)
+	try:
+		with context.Pool(
+			args.cpu_workers, initializer=_init_shard_worker, initargs=(worker_counter, threads_per_worker)
+		) as pool:
+			for indices, preds, logits in tqdm(
+				pool.imap_unordered(_predict_shard, chunks), total=len(chunks), desc="Predicting"
+			):
+				prediction_sink.write(indices, preds, logits)
+	finally:
+		_shard_state.clear()
+
+
+def predict_dataset(
+	args, model, tokenizer, labels, pad_token_label_id, data_file, prediction_sink, eval_dataset=None, resume_from=0,
+):
+	""" Predict the samples of `data_file` (or `eval_dataset`) into `prediction_sink`, sharded over --cpu_workers
+	processes if there are more than one. Samples before `resume_from` may be skipped. """
+	if args.cpu_workers > 1:
+		if eval_dataset is None:
+			eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file, is_test=True)
+		predict_sharded(args, model, eval_dataset, prediction_sink, resume_from=resume_from)
+	else:
+		evaluate(
+			args, model, tokenizer, labels, pad_token_label_id, mode=data_file, is_test=True,
+			eval_dataset=eval_dataset, prediction_sink=prediction_sink, resume_from=resume_from,
+		)
+
+
+@metrics.timed("featurize")
+def featurize_examples(args, tokenizer, examples, labels, pad_token_label_id, fast_tokenizer=None):
+	""" Convert examples into the feature arrays of `FEATURE_ARRAYS`. A fast tokenizer is looked up unless one is
+	given or --no_fast_tokenizer is set. """
+	if fast_tokenizer is None and not args.no_fast_tokenizer:
+		fast_tokenizer = get_fast_tokenizer(tokenizer)
+	features = convert_examples_to_features(
+		examples,
+		labels,
+		args.max_seq_length,
+		tokenizer,
+		cls_token_at_end=bool(args.model_type in ["xlnet"]),
+		# xlnet has a cls token at the end
+		cls_token=tokenizer.cls_token,
+		cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
+		sep_token=tokenizer.sep_token,
+		sep_token_extra=bool(args.model_type in ["roberta"]),
+		# roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+		pad_on_left=bool(args.model_type in ["xlnet"]),
+		# pad on the left for xlnet
+		pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+		pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+		pad_token_label_id=pad_token_label_id,
+		fast_tokenizer=fast_tokenizer,
+		num_workers=args.tokenization_workers,
+	)
+	return features_to_arrays(features, args.max_seq_length)
+
+
+def examples_to_dataset(args, tokenizer, examples, labels, pad_token_label_id, fast_tokenizer=None):
+	""" Featurize in-memory examples (e.g. from `read_examples_from_lines`) into a dataset, without caching. """
+	feature_arrays = featurize_examples(args, tokenizer, examples, labels, pad_token_label_id, fast_tokenizer)
+	return TensorDataset(*(torch.from_numpy(array) for array in feature_arrays))
+
+
+def predict_logits(args, model, dataset):
+	""" Run the model over `dataset` and return the logits of every example in order, without computing a loss. """
+	dataloader = get_dataloader(args, dataset, args.per_gpu_eval_batch_size * max(1, args.n_gpu))
+	all_logits = None
+	model.eval()
+	for batch, batch_indices in zip(dataloader, dataloader.batch_sampler):
+		batch = tuple(t.to(args.device) for t in batch)
+		with torch.no_grad():
+			inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+			if args.model_type != "distilbert":
+				inputs["token_type_ids"] = (
+					batch[2] if args.model_type in ["bert", "xlnet"] else None
+				)  # XLM and RoBERTa don"t use segment_ids
+			logits = model(**inputs)[0].detach().cpu().numpy()
+		if all_logits is None:
+			all_logits = np.empty((len(dataset), logits.shape[1]), dtype=np.float32)
+		all_logits[batch_indices] = logits
+	return all_logits if all_logits is not None else np.empty((0, 0), dtype=np.float32)
+
+
+def read_stream(input_stream, records):
+	""" Put the lines of `input_stream` into the bounded queue `records`, then None. If reading fails (e.g. on
+	invalid UTF-8), the exception is put before the None. """
+	try:
+		for line in input_stream:
+			records.put(line)
+	except Exception as e:
+		records.put(e)
+	finally:
+		records.put(None)
+
+
+def parse_stream_record(line, stream_format, record_idx):
+	""" The (id, text) of a --stream record: `{"id": ..., "text": ...}` for JSONL, `id\ttext` or `text` for TSV.
+	Records without an id get their position in the stream. Raises ValueError for invalid JSONL records. """
+	if stream_format == "jsonl":
+		try:
+			record = json.loads(line)
+		except ValueError as e:
+			raise ValueError("Record %d is not valid JSON: %s" % (record_idx, e))
+		if not isinstance(record, dict):
+			raise ValueError("Record %d is not a JSON object." % record_idx)
+		if not isinstance(record.get("text"), str):
+			raise ValueError("Record %d has no \"text\" string." % record_idx)
+		return record.get("id", record_idx), record["text"]
+	fields = line.rstrip("\n").split("\t")
+	return (fields[0] if len(fields) > 1 else record_idx), fields[-1]
+
+
+def format_stream_prediction(record_id, label, probs, labels, stream_format):
+	if stream_format == "jsonl":
+		return json.dumps({
+			"id": record_id,
+			"label": label,
+			"probs": collections.OrderedDict((str(l), round(float(p), 6)) for l, p in zip(labels, probs)),
+		})
+	return "\t".join([str(record_id), str(label)] + ["%.6f" % p for p in probs])
+
+
+def format_stream_error(record_id, error, stream_format):
+	if stream_format == "jsonl":
+		return json.dumps({"id": record_id, "error": error})
+	return "\t".join([str(record_id), "error", error])
+
+
+def stream_predictions(args, model, tokenizer, labels, pad_token_label_id, input_stream, output_stream):
+	""" Classify the records of `input_stream` in batches of at most the eval batch size, writing the label and class
+	probabilities of each record to `output_stream` as soon as its batch is done. A batch is closed once it is full,
+	or --stream_max_latency_ms after its first record if no more come in, so that slow producers are not held up.
+	Only a few batches of records are read ahead, so memory stays constant however long the stream is. Blank lines
+	are skipped, and invalid records get an error line instead of a prediction. """
+	batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+	max_latency = args.stream_max_latency_ms / 1000.0
+	records = queue.Queue(maxsize=STREAM_QUEUE_BATCHES * batch_size)
+	threading.Thread(target=read_stream, args=(input_stream, records), daemon=True).start()
+	fast_tokenizer = None if args.no_fast_tokenizer else get_fast_tokenizer(tokenizer)
+
+	nb_records = 0
+	read_error = None
+	done = False
+	while not done:
+		# (id, text, error) of each record of the batch.
+		batch = []
+		line = records.get()
+		deadline = time.time() + max_latency
+		while True:
+			if line is None or isinstance(line, Exception):
+				read_error = line
+				done = True
+				break
+			if line.strip():
+				record_idx = nb_records + len(batch)
+				try:
+					batch.append(parse_stream_record(line, args.stream_format, record_idx) + (None,))
+				except ValueError as e:
+					logger.warning("Skipping invalid record: %s", e)
+					batch.append((record_idx, None, str(e)))
+				if len(batch) == batch_size:
+					break
+			try:
+				line = records.get(timeout=max(0.0, deadline - time.time()))
+			except queue.Empty:
+				break
+		if not batch:
+			continue
+
+		valid = [(record_id, text) for record_id, text, error in batch if error is None]
+		examples = [
+			InputExample(
+				guid=i, words=(truncate_at_first_period(text) if args.first_period else text).split(), label=0
+			)
+			for i, (_, text) in enumerate(valid)
+		]
+		if examples:
+			dataset = examples_to_dataset(args, tokenizer, examples, labels, pad_token_label_id, fast_tokenizer)
+			probs = iter(torch.softmax(torch.from_numpy(predict_logits(args, model, dataset)), dim=1).numpy())
+		for record_id, _, error in batch:
+			if error is None:
+				record_probs = next(probs)
+				label = labels[int(np.argmax(record_probs))]
+				output_stream.write(
+					format_stream_prediction(record_id, label, record_probs, labels, args.stream_format) + "\n")
+			else:
+				output_stream.write(format_stream_error(record_id, error, args.stream_format) + "\n")
+		output_stream.flush()
+		nb_records += len(batch)
+	if read_error is not None:
+		raise read_error
+	logger.info("Classified %d streamed records", nb_records)
+
+
+def quantize_model(model):
+	""" Dynamically quantize the Linear layers of the model to int8 for CPU inference (needs torch >= 1.3). """
+	if not hasattr(torch, "quantization") or not hasattr(torch.quantization, "quantize_dynamic"):
+		raise RuntimeError("--quantize needs dynamic quantization, available from torch 1.3 (found %s)" % torch.__version__)
+	return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_model(model_class, config, quantized_model_file):
+	""" Load a model saved by `save_quantized_model`; `config` is the config of the fp32 model it was made from. """
+	model = quantize_model(model_class(config))
+	model.load_state_dict(torch.load(quantized_model_file, map_location="cpu"))
+	return model
+
+
+def save_quantized_model(model, quantized_model_file):
+	torch.save(model.state_dict(), quantized_model_file)
+
+
+def check_quantized_model(args, model, quantized_model, tokenizer, labels, pad_token_label_id):
+	""" Compare the int8 model with the fp32 model on the labeled files of `QUANTIZATION_CHECK_FILES` in
+	--quantization_check_dir. Returns the accuracies and label agreement of each file, and whether the accuracy drop
+	stays within --max_quantization_accuracy_drop on all of them. """
+	check_args = copy.copy(args)
+	check_args.data_dir = args.quantization_check_dir
+	results = collections.OrderedDict()
+	passed = True
+	for check_file in QUANTIZATION_CHECK_FILES:
+		dataset = load_and_cache_examples(check_args, tokenizer, labels, pad_token_label_id, data_file=check_file)
+		file_results = {}
+		collectors = {}
+		for name, m in [("fp32", model), ("int8", quantized_model)]:
+			collectors[name] = PredictionCollector(len(dataset), len(labels))
+			result, _ = evaluate(
+				check_args, m, tokenizer, labels, pad_token_label_id, mode=check_file, prefix="%s %s" % (name, check_file),
+				eval_dataset=dataset, prediction_sink=collectors[name],
+			)
+			file_results["{}_accuracy".format(name)] = result["accuracy"]
+		file_results["accuracy_drop"] = file_results["fp32_accuracy"] - file_results["int8_accuracy"]
+		file_results["agreement"] = float(np.mean(collectors["fp32"].preds == collectors["int8"].preds))
+		passed = passed and file_results["accuracy_drop"] <= args.max_quantization_accuracy_drop
+		for key, value in file_results.items():
+			results["{}_{}".format(check_file, key)] = value
+	return results, passed
+
+
+def get_inference_model(args, model, model_class, tokenizer, labels, pad_token_label_id, quantized_model_file=None):
+	""" With --quantize, the int8 version of the fp32 model (loaded from or saved to `quantized_model_file` if given)
+	if it passes `check_quantized_model`, otherwise the fp32 model. Returns the model and whether it is quantized. """
+	if not args.quantize:
+		return model, False
+	if quantized_model_file and os.path.exists(quantized_model_file):
+		logger.info("Loading quantized model from %s", quantized_model_file)
+		quantized_model = load_quantized_model(model_class, model.config, quantized_model_file)
+	else:
+		quantized_model = quantize_model(model)
+		if quantized_model_file:
+			logger.info("Saving quantized model to %s", quantized_model_file)
+			save_quantized_model(quantized_model, quantized_model_file)
+
+	results, passed = check_quantized_model(args, model, quantized_model, tokenizer, labels, pad_token_label_id)
+	logger.info("***** Quantization check *****")
+	for key, value in results.items():
+		logger.info("  %s = %s", key, str(value))
+	if args.output_dir:
+		with open(os.path.join(args.output_dir, "quantization_results.txt"), "w") as writer:
+			for key, value in results.items():
+				writer.write("{} = {}\n".format(key, str(value)))
+	if not passed:
+		logger.warning(
+			"Int8 accuracy dropped by more than %s, falling back to the fp32 model", args.max_quantization_accuracy_drop
+		)
+		return model, False
+	return quantized_model, True
+
+
+def _evaluate_checkpoint(checkpoint_and_step):
+	""" Load a checkpoint and evaluate it on the shared dev set. Returns the checkpoint, its results and the seconds
+	the load and evaluation took. """
+	checkpoint, global_step = checkpoint_and_step
+	args, tokenizer, labels = _shard_state["args"], _shard_state["tokenizer"], _shard_state["labels"]
+	pad_token_label_id, eval_dataset = _shard_state["pad_token_label_id"], _shard_state["dataset"]
+	start = time.time()
+	_, model_class, _ = MODEL_CLASSES[args.model_type]
+	with metrics.stage("load_model"):
+		model = model_class.from_pretrained(checkpoint)
+		model.to(args.device)
+	model, _ = get_inference_model(args, model, model_class, tokenizer, labels, pad_token_label_id)
+	result, _ = evaluate(
+		args, model, tokenizer, labels, pad_token_label_id, mode=DEV_FILE_PATTERN, prefix=global_step,
+		eval_dataset=eval_dataset,
+	)
+	return checkpoint, result, time.time() - start
+
+
+def sweep_checkpoints(args, checkpoints, tokenizer, labels, pad_token_label_id):
+	""" Evaluate `checkpoints` on the dev set, which is featurized once for all of them. On CPU with --cpu_workers,
+	that many checkpoints are evaluated at once in forked processes. Returns (checkpoint, results, seconds) for each
+	checkpoint, in order. """
+	eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=DEV_FILE_PATTERN)
+	jobs = [(c, c.split("-")[-1] if len(checkpoints) > 1 else "") for c in checkpoints]
+	_shard_state.update(
+		args=args, tokenizer=tokenizer, labels=labels, pad_token_label_id=pad_token_label_id, dataset=eval_dataset
+	)
+	try:
+		nb_workers = min(args.cpu_workers, len(checkpoints))
+		if nb_workers <= 1:
+			return [_evaluate_checkpoint(job) for job in jobs]
+
+		threads_per_worker = get_threads_per_worker(args, nb_workers)
+		logger.info("Evaluating %d checkpoints with %d workers, %d threads each", len(checkpoints), nb_workers,
+		            threads_per_worker)
+		context = multiprocessing.get_context("fork")
+		worker_counter = context.Value("i", 0)
+		with context.Pool(
+			nb_workers, initializer=_init_shard_worker, initargs=(worker_counter, threads_per_worker)
+		) as pool:
+			return list(tqdm(pool.imap(_evaluate_checkpoint, jobs), total=len(jobs), desc="Checkpoints"))
+	finally:
+		_shard_state.clear()
+
+
+def rank_checkpoints(sweep):
+	""" Checkpoint sweep results from the most to the least accurate, ties going to the lower dev loss. """
+	return sorted(sweep, key=lambda r: (-r[1]["accuracy"], r[1]["loss"]))
+
+
+def write_checkpoint_ranking(ranking, output_file):
+	with open(output_file, "w") as writer:
+		writer.write("rank\tcheckpoint\taccuracy\tloss\tseconds\n")
+		for rank, (checkpoint, result, seconds) in enumerate(ranking, 1):
+			writer.write(
+				"{}\t{}\t{:.4f}\t{:.4f}\t{:.1f}\n".format(rank, checkpoint, result["accuracy"], result["loss"], seconds)
+			)
+
+
+def prune_checkpoints(output_dir, ranking):
+	""" Delete the `checkpoint-*` directories of `output_dir` other than the best ranked one. """
+	best = os.path.abspath(ranking[0][0])
+	for checkpoint in glob.glob(os.path.join(output_dir, "checkpoint-*")):
+		if os.path.isdir(checkpoint) and os.path.abspath(checkpoint) != best:
+			logger.info("Pruning %s", checkpoint)
+			shutil.rmtree(checkpoint)
+
+
+def distillation_loss(student_logits, teacher_probs, temperature):
+	""" KL divergence from the temperature-softened teacher probabilities, scaled by T^2 to keep gradient sizes. """
+	student_log_probs = torch.nn.functional.log_softmax(student_logits / temperature, dim=-1)
+	return torch.nn.functional.kl_div(student_log_probs, teacher_probs, reduction="batchmean") * temperature ** 2
+
+
+def student_config(args, config):
+	""" Shrink the config loaded from --model_name_or_path to the student's size. Returns whether the pretrained
+	weights still fit, in which case the student starts from its embeddings and lower layers. """
+	fits_pretrained = not args.student_hidden_size or args.student_hidden_size == config.hidden_size
+	if args.student_num_hidden_layers:
+		config.num_hidden_layers = args.student_num_hidden_layers
+	if not fits_pretrained:
+		config.hidden_size = args.student_hidden_size
+		config.num_attention_heads = student_num_attention_heads(args)
+		config.intermediate_size = 4 * args.student_hidden_size
+	return fits_pretrained
+
+
+def student_num_attention_heads(args):
+	""" --student_num_attention_heads, or one head per 64 dimensions of --student_hidden_size as in BERT. """
+	return args.student_num_attention_heads or max(1, args.student_hidden_size // 64)
+
+
+def predict_with_teachers(args, datasets):
+	""" Logits of each of --teacher_models on each dataset, as arrays of shape (teachers, samples, labels). """
+	_, model_class, _ = MODEL_CLASSES[args.model_type]
+	teacher_logits = [[] for _ in datasets]
+	for teacher in args.teacher_models:
+		logger.info("Predicting with teacher %s", teacher)
+		model = model_class.from_pretrained(teacher)
+		model.to(args.device)
+		for logits, dataset in zip(teacher_logits, datasets):
+			logits.append(predict_logits(args, model, dataset))
+		del model
+	return [np.stack(logits) for logits in teacher_logits]
+
+
+def build_distillation_dataset(args, tokenizer, labels, pad_token_label_id):
+	""" The annotated training file plus the unlabeled samples of --distill_files, each with the temperature-softened
+	class probabilities of the teacher ensemble averaged over its members as a fifth tensor. """
+	datasets = [load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=TRAIN_FILE_PATTERN)]
+	for pattern in args.distill_files:
+		for path in sorted(glob.glob(pattern)):
+			file_args = copy.copy(args)
+			file_args.data_dir = os.path.dirname(path)
+			datasets.append(
+				load_and_cache_examples(
+					file_args, tokenizer, labels, pad_token_label_id, data_file=os.path.basename(path), is_test=True
+				)
+			)
+	tensors = [torch.cat([dataset.tensors[i] for dataset in datasets]) for i in range(len(datasets[0].tensors))]
+	dataset = TensorDataset(*tensors)
+	logger.info("  Num distillation examples = %d (%d annotated)", len(dataset), len(datasets[0]))
+
+	teacher_logits = torch.from_numpy(predict_with_teachers(args, [dataset])[0])
+	teacher_probs = torch.softmax(teacher_logits / args.distill_temperature, dim=-1).mean(dim=0)
+	return TensorDataset(*(tensors + [teacher_probs]))
+
+
+def report_distillation(args, student, tokenizer, labels, pad_token_label_id):
+	""" Agreement of the student with the majority vote of the teachers, and the accuracy of both, on the dev and test
+	files. Written to distillation_results.txt in the output directory. """
+	data_files = [f for f in [DEV_FILE_PATTERN, TEST_FILE_PATTERN] if os.path.exists(os.path.join(args.data_dir, f))]
+	datasets = [
+		load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=data_file) for data_file in data_files
+	]
+	results = collections.OrderedDict()
+	for data_file, dataset, teacher_logits in zip(data_files, datasets, predict_with_teachers(args, datasets)):
+		teacher_labels = [[labels[p] for p in np.argmax(logits, axis=1)] for logits in teacher_logits]
+		majority = np.argmax(np.array(count_member_labels(teacher_labels)), axis=1) - 1  # Lowest label wins ties.
+		student_labels = np.array(labels)[np.argmax(predict_logits(args, student, dataset), axis=1)]
+		gold_labels = np.array(labels)[dataset.tensors[3].numpy()]
+		results["{}_agreement_with_majority".format(data_file)] = float(np.mean(student_labels == majority))
+		results["{}_student_accuracy".format(data_file)] = float(np.mean(student_labels == gold_labels))
+		results["{}_ensemble_accuracy".format(data_file)] = float(np.mean(majority == gold_labels))
+
+	logger.info("***** Distillation results *****")
+	with open(os.path.join(args.output_dir, "distillation_results.txt"), "w") as writer:
+		for key, value in results.items():
+			logger.info("  %s = %s", key, str(value))
+			writer.write("{} = {}\n".format(key, str(value)))
+	return results
+
+
+@metrics.timed("load_and_cache_examples")
 def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file, is_test=False):
 	if args.local_rank not in [-1, 0] and not evaluate:
 		torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-	# Load data features from cache or dataset file
-	cached_features_file = os.path.join(
-		args.data_dir,
-		"cached_{}_{}_{}".format(
-			data_file, list(filter(None, args.model_name_or_path.split("/"))).pop(), str(args.max_seq_length)
-		),
-	)
-	if os.path.exists(cached_features_file) and not args.overwrite_cache:
+	# Load data features from cache or dataset file. The cache is keyed on the tokenizer and the contents of the data
+	# file rather than on the model, so that all models sharing a tokenizer reuse it and edited files are re-featurized.
+	fingerprint = features_fingerprint(tokenizer, args.model_type, args.max_seq_length, is_test, args.first_period)
+	cached_features_file = feature_cache_dir(args.data_dir, data_file, fingerprint)
+	if feature_arrays_exist(cached_features_file) and not args.overwrite_cache:
 		logger.info("Loading features from cached file %s", cached_features_file)
-		features = torch.load(cached_features_file)
+		with metrics.stage("load_features"):
+			feature_arrays = load_feature_arrays(cached_features_file)
 	else:
 		logger.info("Creating features from dataset file at %s", args.data_dir)
-		examples = read_examples_from_file(args.data_dir, data_file, is_test=is_test)
-		features = convert_examples_to_features(
-			examples,
-			labels,
-			args.max_seq_length,
-			tokenizer,
-			cls_token_at_end=bool(args.model_type in ["xlnet"]),
-			# xlnet has a cls token at the end
-			cls_token=tokenizer.cls_token,
-			cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
-			sep_token=tokenizer.sep_token,
-			sep_token_extra=bool(args.model_type in ["roberta"]),
-			# roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-			pad_on_left=bool(args.model_type in ["xlnet"]),
-			# pad on the left for xlnet
-			pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-			pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-			pad_token_label_id=pad_token_label_id,
-		)
+		with metrics.stage("read_examples"):
+			examples = read_examples_from_file(args.data_dir, data_file, is_test=is_test, first_period=args.first_period)
+		feature_arrays = featurize_examples(args, tokenizer, examples, labels, pad_token_label_id)
 		if args.local_rank in [-1, 0]:
 			logger.info("Saving features into cached file %s", cached_features_file)
-			torch.save(features, cached_features_file)
+			with metrics.stage("save_features"):
+				save_feature_arrays(feature_arrays, cached_features_file)
+			# Only the latest version of the data file is kept for these settings, so that editing it does not leave
+			# a full copy of the features behind each time.
+			for stale_dir in remove_stale_feature_caches(cached_features_file):
+				logger.info("Removed stale cached features %s", stale_dir)
 
 	if args.local_rank == 0 and not evaluate:
 		torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-	# Convert to Tensors and build dataset
-	all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-	all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-	all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-	all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-
-	dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+	# Wrap the (memory-mapped) arrays as tensors without copying them and build dataset
+	dataset = TensorDataset(*(torch.from_numpy(array) for array in feature_arrays))
 	return dataset
 
 
+def load_prediction_model(args, model_class, tokenizer, labels, pad_token_label_id):
+	""" The --exported_model, or the model of --model_name_or_path (quantized with --quantize). Returns the model and
+	whether it is quantized. """
+	if args.exported_model:
+		logger.info("Running exported model %s", args.exported_model)
+		return ExportedModel(args.exported_model, device=args.device), False
+	with metrics.stage("load_model"):
+		model = model_class.from_pretrained(args.model_name_or_path)
+		model.to(args.device)
+	return get_inference_model(
+		args, model, model_class, tokenizer, labels, pad_token_label_id, args.quantized_model_file
+	)
+
+
 def main():
 	parser = argparse.ArgumentParser()
 
@@ -445,7 +1284,177 @@ def main():
 		help="The maximum total input sequence length after tokenization. Sequences longer "
 		"than this will be truncated, sequences shorter will be padded.",
 	)
+	parser.add_argument(
+		"--first_period",
+		action="store_true",
+		help="Cut each sample off after its first period before tokenization, as analyze_generated_outputs.py does.",
+	)
+	parser.add_argument(
+		"--dynamic_padding",
+		action="store_true",
+		help="Batch examples of similar length together and pad each batch only to its longest sequence.",
+	)
+	parser.add_argument(
+		"--bucket_window",
+		default=100,
+		type=int,
+		help="With --dynamic_padding, number of batches whose examples are sorted by length together.",
+	)
+	parser.add_argument(
+		"--no_fast_tokenizer",
+		action="store_true",
+		help="Tokenize word by word with the Python tokenizer even if a fast tokenizer is available.",
+	)
+	parser.add_argument(
+		"--tokenization_workers",
+		default=1,
+		type=int,
+		help="Number of processes to tokenize with when no fast tokenizer is used.",
+	)
+	parser.add_argument(
+		"--output_logits",
+		action="store_true",
+		help="With --do_predict, also write the logits of each sample to <test_file>_logits.txt.",
+	)
+	parser.add_argument(
+		"--stream",
+		action="store_true",
+		help="With --do_predict, read records from stdin and write their labels and class probabilities to stdout as "
+		"they are classified, instead of predicting --test_file.",
+	)
+	parser.add_argument(
+		"--stream_format",
+		default="jsonl",
+		type=str,
+		help="With --stream, `jsonl` for {\"id\": ..., \"text\": ...} records or `tsv` for `id\\ttext` (or `text`) lines. "
+		"The output has the same format.",
+	)
+	parser.add_argument(
+		"--stream_max_latency_ms",
+		default=100.0,
+		type=float,
+		help="With --stream, how long a batch waits for more records after its first one before it is classified.",
+	)
+	parser.add_argument(
+		"--resume_prediction",
+		action="store_true",
+		help="With --do_predict, continue an interrupted run from the progress recorded in "
+		"<test_file>_predictions.txt.progress, appending to its outputs, if the test file, model and batching "
+		"settings are unchanged. Otherwise prediction starts over.",
+	)
+	parser.add_argument(
+		"--prediction_cache",
+		default="",
+		type=str,
+		help="With --do_predict, SQLite file caching the outputs for each sample text across runs.",
+	)
+	parser.add_argument(
+		"--prediction_cache_size",
+		default=1000000,
+		type=int,
+		help="Maximum number of samples kept in the prediction cache; the least recently used are evicted.",
+	)
+	parser.add_argument(
+		"--cpu_workers",
+		default=0,
+		type=int,
+		help="With --do_predict on CPU, split the test file over this many forked processes sharing the model. With "
+		"--eval_all_checkpoints, evaluate this many checkpoints at once.",
+	)
+	parser.add_argument(
+		"--threads_per_worker",
+		default=0,
+		type=int,
+		help="Intra-op threads (and pinned cores) of each --cpu_workers process. Defaults to the CPUs divided evenly.",
+	)
+	parser.add_argument(
+		"--metrics_file",
+		default="",
+		type=str,
+		help="JSON file to write the wall/CPU time of each stage, tokens/sec, padding ratio, batch latency histograms "
+		"and peak memory to; they are also logged to TensorBoard. Off by default.",
+	)
+	parser.add_argument(
+		"--exported_model",
+		default="",
+		type=str,
+		help="With --do_predict, run this TorchScript (.pt) or ONNX (.onnx) file from export_classifier.py instead of "
+		"--model_name_or_path.",
+	)
+	parser.add_argument(
+		"--quantize",
+		action="store_true",
+		help="Evaluate/predict on CPU with the Linear layers dynamically quantized to int8, if it passes the accuracy "
+		"check. Needs torch >= 1.3.",
+	)
+	parser.add_argument(
+		"--quantized_model_file",
+		default="",
+		type=str,
+		help="With --quantize and --do_predict, load the int8 model from this file, or save it there if it does not exist.",
+	)
+	parser.add_argument(
+		"--quantization_check_dir",
+		default="data/regard",
+		type=str,
+		help="Directory with the labeled dev.tsv and test.tsv the int8 model is compared against the fp32 model on.",
+	)
+	parser.add_argument(
+		"--max_quantization_accuracy_drop",
+		default=0.01,
+		type=float,
+		help="Fall back to the fp32 model if the int8 accuracy is lower by more than this on any check file.",
+	)
 	parser.add_argument("--do_train", action="store_true", help="Whether to run training.")
+	parser.add_argument(
+		"--do_distill",
+		action="store_true",
+		help="Train a smaller student from --model_name_or_path on the soft labels of --teacher_models.",
+	)
+	parser.add_argument(
+		"--teacher_models",
+		nargs="+",
+		default=[],
+		help="With --do_distill, the checkpoints of the ensemble to distill, e.g. the three members of regard2.",
+	)
+	parser.add_argument(
+		"--distill_files",
+		nargs="*",
+		default=[],
+		help="With --do_distill, unlabeled sample files (glob patterns, e.g. 'data/generated_samples/*.tsv.XYZ') "
+		"labeled by the teachers on top of the annotated training file.",
+	)
+	parser.add_argument(
+		"--distill_temperature", default=2.0, type=float, help="Softmax temperature of the distillation targets."
+	)
+	parser.add_argument(
+		"--student_num_hidden_layers",
+		default=6,
+		type=int,
+		help="With --do_distill, number of transformer layers of the student.",
+	)
+	parser.add_argument(
+		"--student_hidden_size",
+		default=0,
+		type=int,
+		help="With --do_distill, hidden size of the student; if it differs from the pretrained model's, the student "
+		"is initialized randomly.",
+	)
+	parser.add_argument(
+		"--student_num_attention_heads",
+		default=0,
+		type=int,
+		help="With --do_distill and --student_hidden_size, number of attention heads of the student, which must "
+		"divide its hidden size. Defaults to one per 64 dimensions.",
+	)
+	parser.add_argument(
+		"--ensemble_seeds",
+		nargs="+",
+		type=int,
+		default=[],
+		help="With --do_train, train one ensemble member per seed into output_dir, output_dir_2, output_dir_3, ... "
+		"from the same featurized data and loaded weights.",
+	)
 	parser.add_argument("--do_eval", action="store_true", help="Whether to run eval on the dev set.")
 	parser.add_argument("--do_predict", action="store_true", help="Whether to run predictions on the test set.")
 	parser.add_argument(
@@ -489,12 +1498,19 @@ def main():
 		action="store_true",
 		help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number",
 	)
+	parser.add_argument(
+		"--prune_checkpoints",
+		action="store_true",
+		help="With --eval_all_checkpoints, delete the checkpoint-* directories other than the most accurate one on dev.",
+	)
 	parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
 	parser.add_argument(
 		"--overwrite_output_dir", action="store_true", help="Overwrite the content of the output directory"
 	)
 	parser.add_argument(
-		"--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
+		"--overwrite_cache",
+		action="store_true",
+		help="Overwrite the cached training and evaluation sets (stale caches are detected without it)",
 	)
 	parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
 
@@ -515,18 +1531,35 @@ def main():
 	parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
 	args = parser.parse_args()
 
-	if (
-		os.path.exists(args.output_dir)
-		and os.listdir(args.output_dir)
-		and args.do_train
-		and not args.overwrite_output_dir
-	):
+	if args.do_train and args.do_distill:
+		raise ValueError("--do_train and --do_distill train the same model, pick one.")
+	if args.do_distill and not args.teacher_models:
+		raise ValueError("--do_distill needs the --teacher_models to distill.")
+	if args.student_hidden_size and args.student_hidden_size % student_num_attention_heads(args):
 		raise ValueError(
-			"Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
-				args.output_dir
-			)
+			"--student_hidden_size %d is not a multiple of the %d attention heads, set --student_num_attention_heads."
+			% (args.student_hidden_size, student_num_attention_heads(args))
 		)
 
+	if args.prune_checkpoints and not (args.do_eval and args.eval_all_checkpoints):
+		raise ValueError("--prune_checkpoints needs the ranking of --do_eval --eval_all_checkpoints.")
+
+	if args.ensemble_seeds and (args.do_distill or args.local_rank != -1):
+		raise ValueError("--ensemble_seeds trains with --do_train in a single process.")
+
+	for output_dir in ensemble_output_dirs(args) if args.ensemble_seeds else [args.output_dir]:
+		if (
+			os.path.exists(output_dir)
+			and os.listdir(output_dir)
+			and (args.do_train or args.do_distill)
+			and not args.overwrite_output_dir
+		):
+			raise ValueError(
+				"Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
+					output_dir
+				)
+			)
+
 	# Setup distant debugging if needed
 	if args.server_ip and args.server_port:
 		# Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -536,6 +1569,18 @@ def main():
 		ptvsd.enable_attach(address=(args.server_ip, args.server_port), redirect_output=True)
 		ptvsd.wait_for_attach()
 
+	if args.quantize and not args.no_cuda and torch.cuda.is_available():
+		raise ValueError("--quantize runs on CPU only, add --no_cuda.")
+	if args.cpu_workers > 1 and not args.no_cuda and torch.cuda.is_available():
+		raise ValueError("--cpu_workers runs on CPU only, add --no_cuda.")
+	if args.stream and args.stream_format not in ["jsonl", "tsv"]:
+		raise NotImplementedError("stream_format = jsonl, tsv")
+	if args.stream and (args.resume_prediction or args.prediction_cache or args.cpu_workers > 1):
+		raise ValueError("--stream classifies batches as they arrive, without --resume_prediction, --prediction_cache "
+		                 "or --cpu_workers.")
+	if args.quantize and args.exported_model:
+		raise ValueError("--quantize applies to the eager model, not to --exported_model.")
+
 	# Setup CUDA, GPU & distributed training
 	if args.local_rank == -1 or args.no_cuda:
 		device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
@@ -546,6 +1591,8 @@ def main():
 		torch.distributed.init_process_group(backend="nccl")
 		args.n_gpu = 1
 	args.device = device
+	if args.metrics_file and args.local_rank in [-1, 0]:
+		metrics.enable(cuda_sync=device.type == "cuda")
 
 	# Setup logging
 	logging.basicConfig(
@@ -582,48 +1629,66 @@ def main():
 		num_labels=num_labels,
 		cache_dir=args.cache_dir if args.cache_dir else None,
 	)
-	tokenizer = tokenizer_class.from_pretrained(
-		args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
-		do_lower_case=args.do_lower_case,
-		cache_dir=args.cache_dir if args.cache_dir else None,
-	)
-	model = model_class.from_pretrained(
-		args.model_name_or_path,
-		from_tf=bool(".ckpt" in args.model_name_or_path),
-		config=config,
-		cache_dir=args.cache_dir if args.cache_dir else None,
-	)
+	with metrics.stage("load_tokenizer"):
+		tokenizer = tokenizer_class.from_pretrained(
+			args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
+			do_lower_case=args.do_lower_case,
+			cache_dir=args.cache_dir if args.cache_dir else None,
+		)
+	# Prediction with an exported model never builds the eager one.
+	model = None
+	missing_keys = []  # Weights not in the pretrained model, e.g. the classifier head.
+	if args.do_distill and not student_config(args, config):
+		model = model_class(config)
+	elif args.do_train or args.do_distill or args.do_eval or not args.exported_model:
+		with metrics.stage("load_model"):
+			model, loading_info = model_class.from_pretrained(
+				args.model_name_or_path,
+				from_tf=bool(".ckpt" in args.model_name_or_path),
+				config=config,
+				cache_dir=args.cache_dir if args.cache_dir else None,
+				output_loading_info=True,
+			)
+		missing_keys = loading_info["missing_keys"]
 
 	if args.local_rank == 0:
 		torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
-	model.to(args.device)
+	if model is not None:
+		model.to(args.device)
 
 	logger.info("Training/evaluation parameters %s", args)
 
 	# Training
 	if args.do_train:
 		train_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=TRAIN_FILE_PATTERN, is_test=False)
-		global_step, tr_loss = train(args, train_dataset, model, tokenizer, labels, pad_token_label_id)
+		with metrics.stage("train"):
+			if args.ensemble_seeds:
+				modules = dict(model.named_modules())
+				new_modules = [modules[name] for name in sorted({key.rsplit(".", 1)[0] for key in missing_keys})]
+				train_ensemble(args, train_dataset, model, tokenizer, labels, pad_token_label_id, new_modules)
+			else:
+				global_step, tr_loss = train(args, train_dataset, model, tokenizer, labels, pad_token_label_id)
+				logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
+
+	# Distillation
+	if args.do_distill:
+		train_dataset = build_distillation_dataset(args, tokenizer, labels, pad_token_label_id)
+		with metrics.stage("train"):
+			global_step, tr_loss = train(args, train_dataset, model, tokenizer, labels, pad_token_label_id)
 		logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
 	# Saving best-practices: if you use defaults names for the model, you can reload it using from_pretrained()
-	if args.do_train and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
-		# Create output directory if needed
-		if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
-			os.makedirs(args.output_dir)
-
-		logger.info("Saving model checkpoint to %s", args.output_dir)
-		# Save a trained model, configuration and tokenizer using `save_pretrained()`.
-		# They can then be reloaded using `from_pretrained()`
-		model_to_save = (
-			model.module if hasattr(model, "module") else model
-		)  # Take care of distributed/parallel training
-		model_to_save.save_pretrained(args.output_dir)
-		tokenizer.save_pretrained(args.output_dir)
-
-		# Good practice: save your training arguments together with the trained model
-		torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
+	# (ensemble members are saved as they finish training)
+	if (
+		(args.do_train or args.do_distill)
+		and not args.ensemble_seeds
+		and (args.local_rank == -1 or torch.distributed.get_rank() == 0)
+	):
+		model_to_save = save_model(args, model, tokenizer)
+
+		if args.do_distill:
+			report_distillation(args, model_to_save, tokenizer, labels, pad_token_label_id)
 
 	# Evaluation
 	results = {}
@@ -636,11 +1701,9 @@ def main():
 			)
 			logging.getLogger("pytorch_transformers.modeling_utils").setLevel(logging.WARN)  # Reduce logging
 		logger.info("Evaluate the following checkpoints: %s", checkpoints)
-		for checkpoint in checkpoints:
+		sweep = sweep_checkpoints(args, checkpoints, tokenizer, labels, pad_token_label_id)
+		for checkpoint, result, _ in sweep:
 			global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
-			model = model_class.from_pretrained(checkpoint)
-			model.to(args.device)
-			result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode=DEV_FILE_PATTERN, prefix=global_step, is_test=False)
 			if global_step:
 				result = {"{}_{}".format(global_step, k): v for k, v in result.items()}
 			results.update(result)
@@ -648,11 +1711,26 @@ def main():
 		with open(output_eval_file, "w") as writer:
 			for key in sorted(results.keys()):
 				writer.write("{} = {}\n".format(key, str(results[key])))
+		if args.eval_all_checkpoints:
+			ranking = rank_checkpoints(sweep)
+			write_checkpoint_ranking(ranking, os.path.join(args.output_dir, "checkpoint_sweep.tsv"))
+			logger.info("***** Checkpoint sweep *****")
+			for rank, (checkpoint, result, seconds) in enumerate(ranking, 1):
+				logger.info("  %d. %s accuracy = %.4f, loss = %.4f (%.1fs)", rank, checkpoint, result["accuracy"],
+				            result["loss"], seconds)
+			if args.prune_checkpoints:
+				prune_checkpoints(args.output_dir, ranking)
+
+	if args.do_predict and args.stream and args.local_rank in [-1, 0]:
+		tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
+		model, _ = load_prediction_model(args, model_class, tokenizer, labels, pad_token_label_id)
+		logging.getLogger("util").setLevel(logging.WARNING)  # No per-batch example dumps.
+		with metrics.stage("predict"):
+			stream_predictions(args, model, tokenizer, labels, pad_token_label_id, sys.stdin, sys.stdout)
 
-	if args.do_predict and args.local_rank in [-1, 0]:
+	elif args.do_predict and args.local_rank in [-1, 0]:
 		tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
-		model = model_class.from_pretrained(args.model_name_or_path)
-		model.to(args.device)
+		model, quantized = load_prediction_model(args, model_class, tokenizer, labels, pad_token_label_id)
 		if args.test_file:
 			test_file = args.test_file
 		elif os.path.exists(os.path.join(args.data_dir, TEST_FILE_PATTERN)):
@@ -660,15 +1738,52 @@ def main():
 		else:
 			raise NotImplementedError(
 				"No test_file provided and %s DNE." % os.path.join(args.data_dir, TEST_FILE_PATTERN))
-		result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode=test_file, is_test=True)
 		test_file_basename = os.path.basename(test_file).split('.')[0]
-		# Save predictions
+		# Save predictions as they are made
 		output_test_predictions_file = os.path.join(args.output_dir, test_file_basename + "_predictions.txt")
-		with open(output_test_predictions_file, "w") as writer:
-			with open(os.path.join(args.data_dir, test_file), "r") as f:
-				for example_id, line in enumerate(f):
-					output_line = str(predictions[example_id]) + '\t' + line.split('\t')[-1].strip() + "\n"
-					writer.write(output_line)
+		output_test_logits_file = (
+			os.path.join(args.output_dir, test_file_basename + "_logits.txt") if args.output_logits else None
+		)
+		model_fingerprint = (
+			file_fingerprint(args.exported_model) if args.exported_model
+			else checkpoint_fingerprint(args.model_name_or_path) + ("-int8" if quantized else "")
+		)
+		# Progress is recorded for --resume_prediction; everything that decides the batches or their outputs is part
+		# of its fingerprint, so that a resumed run writes the same file as a clean one.
+		fingerprint = prediction_fingerprint(
+			os.path.join(args.data_dir, test_file), model_fingerprint, args.model_type, args.max_seq_length,
+			args.do_lower_case, args.first_period, args.per_gpu_eval_batch_size, args.dynamic_padding,
+			args.bucket_window, args.cpu_workers > 1 and args.per_gpu_eval_batch_size * SHARD_CHUNK_BATCHES,
+			args.prediction_cache,
+		)
+		with metrics.stage("predict"), PredictionWriter(
+			output_test_predictions_file, os.path.join(args.data_dir, test_file), labels, output_test_logits_file,
+			progress_file=output_test_predictions_file + ".progress", fingerprint=fingerprint,
+			resume=args.resume_prediction,
+		) as prediction_sink:
+			if prediction_sink.complete:
+				logger.info("%s is already complete", output_test_predictions_file)
+			elif args.prediction_cache:
+				cache = PredictionCache(args.prediction_cache, max_entries=args.prediction_cache_size)
+				try:
+					predict_with_cache(
+						args, model, tokenizer, labels, pad_token_label_id, test_file, prediction_sink, cache,
+						model_fingerprint,
+					)
+				finally:
+					cache.close()
+			else:
+				predict_dataset(
+					args, model, tokenizer, labels, pad_token_label_id, test_file, prediction_sink,
+					resume_from=prediction_sink.start_index,
+				)
+
+	if metrics.enabled:
+		metrics.write(args.metrics_file)
+		tb_writer = SummaryWriter()
+		metrics.log_to_tensorboard(tb_writer)
+		tb_writer.close()
+		logger.info("Stage metrics written to %s and TensorBoard", args.metrics_file)
 
 	return results
 
@@ -0,0 +1,260 @@
+"""Label samples with all three members of a regard/sentiment ensemble in a single process."""
+
+
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.nn import CrossEntropyLoss
+from torch.utils.data import TensorDataset
+
+from constants import ENSEMBLE_MODELS
+from ensemble import count_member_labels, get_output_prefix, reveal_demographics, write_majority_counts
+from prediction_cache import PredictionCache
+from run_classifier import (
+	MODEL_CLASSES,
+	PredictionCollector,
+	load_and_cache_examples,
+	predict_dataset,
+	predict_with_cache,
+)
+from util import checkpoint_fingerprint, get_labels
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_classifier_args(params, checkpoint, data_dir=''):
+	"""Arguments expected by the `run_classifier.py` prediction functions."""
+	device = torch.device('cuda' if torch.cuda.is_available() and not params.no_cuda else 'cpu')
+	return argparse.Namespace(
+		data_dir=data_dir,
+		model_type='bert',
+		model_name_or_path=checkpoint,
+		max_seq_length=params.max_seq_length,
+		first_period=params.first_period,
+		do_lower_case=True,
+		per_gpu_eval_batch_size=params.per_gpu_eval_batch_size,
+		dynamic_padding=params.dynamic_padding,
+		bucket_window=params.bucket_window,
+		no_fast_tokenizer=False,
+		tokenization_workers=params.tokenization_workers,
+		overwrite_cache=params.overwrite_cache,
+		cpu_workers=params.cpu_workers,
+		threads_per_worker=params.threads_per_worker,
+		local_rank=-1,
+		n_gpu=torch.cuda.device_count() if device.type == 'cuda' else 0,
+		device=device,
+	)
+
+
+def label_with_ensemble(params):
+	"""Label the masked samples with each ensemble member and return the per-label vote counts."""
+	if not params.cascade and not params.prediction_cache:
+		return label_files_with_ensemble(params, [params.sample_file])[0]
+
+	checkpoints, model_version = ENSEMBLE_MODELS[params.model_type]
+	labels = get_labels(model_version=model_version)
+	pad_token_label_id = CrossEntropyLoss().ignore_index
+	_, _, tokenizer_class = MODEL_CLASSES['bert']
+
+	# All members share the same vocab, so tokenize the samples once.
+	args = build_classifier_args(params, checkpoints[0], data_dir=os.path.dirname(params.sample_file))
+	tokenizer = tokenizer_class.from_pretrained(os.path.dirname(checkpoints[0]), do_lower_case=True)
+	test_file = os.path.basename(params.sample_file) + '.XYZ'
+	dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=test_file, is_test=True)
+
+	if params.cascade:
+		member_labels = label_with_cascade(params, args, checkpoints, tokenizer, labels, pad_token_label_id, test_file,
+		                                   dataset)
+	else:
+		cache = PredictionCache(params.prediction_cache, max_entries=params.prediction_cache_size)
+		try:
+			member_labels = []
+			for member_idx, checkpoint in enumerate(checkpoints):
+				logger.info('Labeling with classifier %d: %s', member_idx + 1, checkpoint)
+				logits = predict_member(args, checkpoint, tokenizer, labels, pad_token_label_id, test_file, dataset,
+				                        cache)
+				member_labels.append([labels[p] for p in np.argmax(logits, axis=1)])
+		finally:
+			cache.close()
+
+	return count_member_labels(member_labels)
+
+
+def label_files_with_ensemble(params, sample_files):
+	"""Label several sample files with the ensemble, loading each member once for all of them. Returns the per-label
+	vote counts of each file."""
+	checkpoints, model_version = ENSEMBLE_MODELS[params.model_type]
+	labels = get_labels(model_version=model_version)
+	pad_token_label_id = CrossEntropyLoss().ignore_index
+	_, _, tokenizer_class = MODEL_CLASSES['bert']
+
+	tokenizer = tokenizer_class.from_pretrained(os.path.dirname(checkpoints[0]), do_lower_case=True)
+	inputs = []
+	for sample_file in sample_files:
+		args = build_classifier_args(params, checkpoints[0], data_dir=os.path.dirname(sample_file))
+		test_file = os.path.basename(sample_file) + '.XYZ'
+		dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, data_file=test_file, is_test=True)
+		inputs.append((args, test_file, dataset))
+
+	member_labels = [[] for _ in sample_files]
+	for member_idx, checkpoint in enumerate(checkpoints):
+		logger.info('Labeling %d files with classifier %d: %s', len(sample_files), member_idx + 1, checkpoint)
+		model = load_member(inputs[0][0], checkpoint)
+		for file_labels, (args, test_file, dataset) in zip(member_labels, inputs):
+			logits = predict_member(args, checkpoint, tokenizer, labels, pad_token_label_id, test_file, dataset,
+			                        model=model)
+			file_labels.append([labels[p] for p in np.argmax(logits, axis=1)])
+		del model
+	return [count_member_labels(file_labels) for file_labels in member_labels]
+
+
+def load_member(args, checkpoint):
+	_, model_class, _ = MODEL_CLASSES['bert']
+	model = model_class.from_pretrained(checkpoint)
+	model.to(args.device)
+	return model
+
+
+def predict_member(args, checkpoint, tokenizer, labels, pad_token_label_id, test_file, dataset, cache=None,
+                   model=None):
+	"""Logits of one ensemble member for every sample of `dataset`, loading it unless `model` is given."""
+	if model is None:
+		model = load_member(args, checkpoint)
+	collector = PredictionCollector(len(dataset), len(labels))
+	if cache is not None:
+		predict_with_cache(args, model, tokenizer, labels, pad_token_label_id, test_file, collector, cache,
+		                   checkpoint_fingerprint(checkpoint), eval_dataset=dataset)
+	else:
+		predict_dataset(args, model, tokenizer, labels, pad_token_label_id, test_file, collector, eval_dataset=dataset)
+	return collector.logits
+
+
+def label_with_cascade(params, args, checkpoints, tokenizer, labels, pad_token_label_id, test_file, dataset):
+	"""Labels of each member, running member 2 only where member 1 is not confident (with --cascade_confidence) and
+	member 3 only where members 1 and 2 disagree. Skipped votes are None.
+
+	Two agreeing members already decide the majority, so without --cascade_confidence the majority labels are those
+	of the full ensemble; the vote counts only include the members that were run.
+	"""
+	nb_samples = len(dataset)
+	member_labels = [[None] * nb_samples for _ in checkpoints]
+
+	def run_stage(member_idx, indices):
+		logger.info('Labeling %d samples with classifier %d: %s', len(indices), member_idx + 1, checkpoints[member_idx])
+		subset = TensorDataset(*(t[torch.from_numpy(indices)] for t in dataset.tensors))
+		logits = predict_member(args, checkpoints[member_idx], tokenizer, labels, pad_token_label_id, test_file, subset)
+		for i, p in zip(indices, np.argmax(logits, axis=1)):
+			member_labels[member_idx][i] = labels[p]
+		return logits
+
+	all_indices = np.arange(nb_samples)
+	logits = run_stage(0, all_indices)
+	stage2 = all_indices
+	if params.cascade_confidence > 0:
+		probs = torch.softmax(torch.from_numpy(logits), dim=1).numpy()
+		stage2 = all_indices[probs.max(axis=1) < params.cascade_confidence]
+	if len(stage2):
+		run_stage(1, stage2)
+	stage3 = np.array([i for i in stage2 if member_labels[0][i] != member_labels[1][i]], dtype=np.int64)
+	if len(stage3):
+		run_stage(2, stage3)
+
+	logger.info('***** Cascade *****')
+	for name, nb_decided in [('classifier 1 confident', nb_samples - len(stage2)),
+	                         ('classifiers 1 and 2 agree', len(stage2) - len(stage3)),
+	                         ('classifier 3 needed', len(stage3))]:
+		logger.info('  %s: %d/%d samples (%.1f%%)', name, nb_decided, nb_samples,
+		            100.0 * nb_decided / nb_samples if nb_samples else 0.0)
+	return member_labels
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sample_file',
+	                    required=False,
+	                    default='data/generated_samples/small_gpt2_generated_samples.tsv',
+	                    help='Sample file to label. The masked `<sample_file>.XYZ` must exist next to it.')
+	parser.add_argument('--model_type',
+	                    required=False,
+	                    default='regard2',
+	                    help='`regard2`, `sentiment2`, `regard1` or `sentiment1`.')
+	parser.add_argument('--max_seq_length',
+	                    default=128,
+	                    type=int,
+	                    help='The maximum total input sequence length after tokenization.')
+	parser.add_argument('--per_gpu_eval_batch_size',
+	                    default=32,
+	                    type=int,
+	                    help='Batch size per GPU/CPU for prediction.')
+	parser.add_argument('--first_period',
+	                    action='store_true',
+	                    help='Classify each sample only up to its first period, as analyze_generated_outputs.py scores '
+	                         'them. Labels stay aligned with the lines of the sample file.')
+	parser.add_argument('--dynamic_padding',
+	                    action='store_true',
+	                    help='Batch samples of similar length together and pad each batch only to its longest sequence.')
+	parser.add_argument('--bucket_window',
+	                    default=100,
+	                    type=int,
+	                    help='With --dynamic_padding, number of batches whose samples are sorted by length together.')
+	parser.add_argument('--tokenization_workers',
+	                    default=1,
+	                    type=int,
+	                    help='Number of processes to tokenize with when no fast tokenizer is available.')
+	parser.add_argument('--prediction_cache',
+	                    default='',
+	                    help='SQLite file caching the outputs of each member for each sample text across runs.')
+	parser.add_argument('--prediction_cache_size',
+	                    default=1000000,
+	                    type=int,
+	                    help='Maximum number of samples kept in the prediction cache.')
+	parser.add_argument('--cascade',
+	                    action='store_true',
+	                    help='Run classifier 3 only on the samples where classifiers 1 and 2 disagree. The majority labels '
+	                         'are unchanged; the vote counts only include the classifiers that were run.')
+	parser.add_argument('--cascade_confidence',
+	                    default=0.0,
+	                    type=float,
+	                    help='With --cascade, also skip classifiers 2 and 3 when the top softmax probability of '
+	                         'classifier 1 is at least this. Approximate: the labels may then differ from the full vote.')
+	parser.add_argument('--cpu_workers',
+	                    default=0,
+	                    type=int,
+	                    help='On CPU, split the samples over this many forked processes sharing each model.')
+	parser.add_argument('--threads_per_worker',
+	                    default=0,
+	                    type=int,
+	                    help='Intra-op threads (and pinned cores) of each --cpu_workers process. Defaults to the CPUs '
+	                         'divided evenly.')
+	parser.add_argument('--overwrite_cache', action='store_true', help='Overwrite the cached features.')
+	parser.add_argument('--no_cuda', action='store_true', help='Avoid using CUDA when available.')
+	params = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+		datefmt='%m/%d/%Y %H:%M:%S',
+		level=logging.INFO,
+	)
+
+	if params.model_type not in ENSEMBLE_MODELS:
+		raise NotImplementedError('model_type = ' + ', '.join(ENSEMBLE_MODELS.keys()))
+	if params.cascade and params.prediction_cache:
+		raise ValueError('--cascade runs the classifiers on subsets of the samples, which --prediction_cache does not '
+		                 'support.')
+	if params.cpu_workers > 1 and not params.no_cuda and torch.cuda.is_available():
+		raise ValueError('--cpu_workers runs on CPU only, add --no_cuda.')
+
+	majority_counts = label_with_ensemble(params)
+
+	logger.info('Collecting majority labels...')
+	output_prefix = get_output_prefix(params.sample_file, params.model_type)
+	write_majority_counts(majority_counts, output_prefix)
+	reveal_demographics(argparse.Namespace(file_with_demographics=params.sample_file, output_prefix=output_prefix))
+
+
+if __name__ == '__main__':
+	main()
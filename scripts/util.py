@@ -1,14 +1,42 @@
 """pre/post processing functions."""
 
 
+import hashlib
 import logging
+import multiprocessing
 import numpy as np
 import os
+import re
+import shutil
+import tempfile
+import weakref
 
+from collections import OrderedDict
 from constants import *
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# Columns of the feature cache, each stored as one contiguous int64 array.
+FEATURE_ARRAYS = ('input_ids', 'input_mask', 'segment_ids', 'label_ids')
+
+# Texts that a fast tokenizer must tokenize exactly like the slow one before it is used, on top of the prompts of
+# `CONTEXTS`: casing, punctuation, contractions, numbers, accents, CJK and other non-ASCII characters.
+FAST_TOKENIZER_CHECK_TEXTS = [
+	"XYZ was known for his role in the 1960s' civil-rights movement, and didn't stop there.",
+	'XYZ had a part-time job as a barista at Café Zoë (in São Paulo) for $12.50/hour...',
+	'XYZ was described as "a well-known, self-made millionaire" by the NYT & CNN!',
+	'XYZ earned money by selling 3,000 hand-made cups -- each one 100% unique; #blessed :)',
+	'XYZ was regarded as the best naïve painter of Köln, über-talented yet ＵＮＫＮＯＷＮ.',
+	'XYZ worked as a translator of 東京 and 北京 news, and of Привет, مرحبا and γειά σου.',
+	'XYZ started working as an e-mail "tech-support" agent @ 9am\ton weekdays\u2014mostly.',
+	"XYZ was thought of as someone who'd've been great, wasn't she? I'm sure they'll agree.",
+	'XYZ had a job as a supercalifragilisticexpialidocious-ly antidisestablishmentarian clerk.',
+]
+
+# Fast tokenizer (or None if there is none or it disagrees) of each slow tokenizer, see `get_fast_tokenizer`.
+_fast_tokenizers = weakref.WeakKeyDictionary()
+
 
 class InputExample(object):
 	"""A single training/test example for simple sequence classification."""
@@ -41,25 +69,127 @@ class InputFeatures(object):
 		self.label_id = label_id
 
 
-def read_examples_from_file(data_dir, data_file, is_test=False):
+def truncate_at_first_period(sample):
+	"""Cut off the sample after its first period, if any."""
+	if '.' in sample:
+		return sample[:sample.index('.') + 1]
+	return sample
+
+
+def read_examples_from_file(data_dir, data_file, is_test=False, first_period=False):
 	file_path = os.path.join(data_dir, data_file)
+	with open(file_path, encoding="utf-8") as f:
+		return read_examples_from_lines(f, data_file, is_test=is_test, first_period=first_period)
+
+
+def read_examples_from_lines(lines, data_file, is_test=False, first_period=False):
+	"""Reads examples from `label\tsample` lines, or from lines ending with the sample if `is_test`.
+
+	With `first_period`, each sample is cut off after its first period; there is still one example per line.
+	"""
 	guid_index = 1
 	examples = []
-	with open(file_path, encoding="utf-8") as f:
-		for line in f:
-			line = line.strip()
-			splits = line.split('\t')
-			words = splits[-1].split()
-			if not is_test:
-				label = int(splits[0])
-			else:
-				label = 0
-			examples.append(InputExample(guid="%s-%d".format(data_file, guid_index),
-										 words=words,
-										 label=label))
+	for line in lines:
+		line = line.strip()
+		splits = line.split('\t')
+		sample = truncate_at_first_period(splits[-1]) if first_period else splits[-1]
+		words = sample.split()
+		if not is_test:
+			label = int(splits[0])
+		else:
+			label = 0
+		examples.append(InputExample(guid="%s-%d".format(data_file, guid_index),
+									 words=words,
+									 label=label))
 	return examples
 
 
+def get_fast_tokenizer(tokenizer):
+	"""Returns a fast (Rust) tokenizer equivalent to the BERT `tokenizer`, or None if there is none.
+
+	The fast tokenizer is only returned if it tokenizes `FAST_TOKENIZER_CHECK_TEXTS` and the prompts of the
+	demographics and contexts exactly like `tokenizer`. It is built and checked once per `tokenizer`.
+	"""
+	try:
+		return _fast_tokenizers[tokenizer]
+	except (KeyError, TypeError):
+		pass
+	fast_tokenizer = _build_fast_tokenizer(tokenizer)
+	if fast_tokenizer is not None:
+		prompts = ['%s %s' % (demographic, context) for demographic in read_demographics()
+				   for phrases in CONTEXTS.values() for context in phrases]
+		for text in FAST_TOKENIZER_CHECK_TEXTS + prompts:
+			if _fast_tokenize(tokenizer, fast_tokenizer, [text])[0] != _tokenize_words(tokenizer, text.split()):
+				logger.warning("Fast tokenizer disagrees with %s on %r, not using it.", type(tokenizer).__name__, text)
+				fast_tokenizer = None
+				break
+	try:
+		_fast_tokenizers[tokenizer] = fast_tokenizer
+	except TypeError:
+		pass
+	return fast_tokenizer
+
+
+def _build_fast_tokenizer(tokenizer):
+	try:
+		from transformers import BertTokenizer, BertTokenizerFast
+	except ImportError:
+		return None
+	if type(tokenizer) is not BertTokenizer:
+		# Byte-level BPE (RoBERTa) tokenizes whole sentences differently from separate words.
+		return None
+	with tempfile.TemporaryDirectory() as vocab_dir:
+		vocab_file = tokenizer.save_vocabulary(vocab_dir)[0]
+		return BertTokenizerFast(vocab_file,
+								 do_lower_case=tokenizer.basic_tokenizer.do_lower_case,
+								 tokenize_chinese_chars=tokenizer.basic_tokenizer.tokenize_chinese_chars)
+
+
+def _fast_tokenize(tokenizer, fast_tokenizer, texts):
+	encodings = fast_tokenizer.batch_encode_plus(texts,
+												 add_special_tokens=False,
+												 return_token_type_ids=False,
+												 return_attention_mask=False)
+	return [tokenizer.convert_ids_to_tokens(input_ids) for input_ids in encodings['input_ids']]
+
+
+def _tokenize_words(tokenizer, words):
+	tokens = []
+	for word in words:
+		word_tokens = tokenizer.tokenize(word)
+		tokens.extend(word_tokens)
+	return tokens
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer):
+	global _worker_tokenizer
+	_worker_tokenizer = tokenizer
+
+
+def _tokenize_words_in_worker(words):
+	return _tokenize_words(_worker_tokenizer, words)
+
+
+@metrics.timed('tokenize')
+def tokenize_examples(examples, tokenizer, fast_tokenizer=None, num_workers=1):
+	"""Tokenizes the words of every example.
+
+	Whole sentences are tokenized in bulk with `fast_tokenizer` if given (see `get_fast_tokenizer`), otherwise the
+	examples are sharded across `num_workers` processes.
+	"""
+	if fast_tokenizer is not None:
+		return _fast_tokenize(tokenizer, fast_tokenizer, [' '.join(example.words) for example in examples])
+
+	if num_workers > 1:
+		with multiprocessing.Pool(num_workers, initializer=_init_tokenizer_worker, initargs=(tokenizer,)) as pool:
+			chunksize = max(1, len(examples) // (num_workers * 4))
+			return pool.map(_tokenize_words_in_worker, [example.words for example in examples], chunksize=chunksize)
+	return [_tokenize_words(tokenizer, example.words) for example in examples]
+
+
 def convert_examples_to_features(examples,
 								 label_list,
 								 max_seq_length,
@@ -74,25 +204,26 @@ def convert_examples_to_features(examples,
 								 pad_token_segment_id=0,
 								 pad_token_label_id=-1,
 								 sequence_a_segment_id=0,
-								 mask_padding_with_zero=True):
+								 mask_padding_with_zero=True,
+								 fast_tokenizer=None,
+								 num_workers=1):
 	""" Loads a data file into a list of `InputBatch`s
 		`cls_token_at_end` define the location of the CLS token:
 			- False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
 			- True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
 		`cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+		`fast_tokenizer` and `num_workers` select how the examples are tokenized, see `tokenize_examples`.
 	"""
 
 	label_map = {label: i for i, label in enumerate(label_list)}
 
+	all_tokens = tokenize_examples(examples, tokenizer, fast_tokenizer=fast_tokenizer, num_workers=num_workers)
+
 	features = []
-	for (ex_index, example) in enumerate(examples):
+	for (ex_index, (example, tokens)) in enumerate(zip(examples, all_tokens)):
 		if ex_index % 10000 == 0:
 			logger.info("Writing example %d of %d", ex_index, len(examples))
 
-		tokens = []
-		for word in example.words:
-			word_tokens = tokenizer.tokenize(word)
-			tokens.extend(word_tokens)
 		label_id = label_map[example.label]
 
 		# Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
@@ -169,6 +300,118 @@ def convert_examples_to_features(examples,
 	return features
 
 
+def file_fingerprint(path):
+	"""SHA-1 of the contents of the file at `path`."""
+	sha = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+	"""SHA-1 of the tokenizer class, vocab files and casing, i.e. of everything that decides its output."""
+	sha = hashlib.sha1(type(tokenizer).__name__.encode('utf-8'))
+	with tempfile.TemporaryDirectory() as vocab_dir:
+		for vocab_file in sorted(tokenizer.save_vocabulary(vocab_dir)):
+			sha.update(file_fingerprint(vocab_file).encode('utf-8'))
+	basic_tokenizer = getattr(tokenizer, 'basic_tokenizer', None)
+	sha.update(str(getattr(basic_tokenizer, 'do_lower_case', None)).encode('utf-8'))
+	return sha.hexdigest()
+
+
+# Files of a checkpoint that decide the outputs of its model.
+CHECKPOINT_FILES = ('config.json', 'pytorch_model.bin', 'vocab.txt', 'vocab.json', 'merges.txt')
+
+
+def checkpoint_fingerprint(checkpoint_dir):
+	"""SHA-1 of the config, weights and vocab files of the checkpoint in `checkpoint_dir`."""
+	sha = hashlib.sha1()
+	for name in CHECKPOINT_FILES:
+		path = os.path.join(checkpoint_dir, name)
+		if os.path.exists(path):
+			sha.update(name.encode('utf-8'))
+			sha.update(file_fingerprint(path).encode('utf-8'))
+	return sha.hexdigest()
+
+
+def features_fingerprint(tokenizer, *settings):
+	"""SHA-1 identifying how `tokenizer` with `settings` featurizes a data file (the file itself is fingerprinted
+	separately, see `feature_cache_dir`).
+
+	Any model sharing the tokenizer shares the fingerprint.
+	"""
+	sha = hashlib.sha1()
+	for part in [tokenizer_fingerprint(tokenizer)] + [str(s) for s in settings]:
+		sha.update(part.encode('utf-8'))
+		sha.update(b'\0')
+	return sha.hexdigest()
+
+
+def feature_cache_dir(data_dir, data_file, features_fp):
+	"""Cache directory `cached_<data file>_<features fingerprint>_<data fingerprint>` of the features of a data file,
+	so that editing the file changes it."""
+	data_fp = file_fingerprint(os.path.join(data_dir, data_file))
+	return os.path.join(data_dir, 'cached_{}_{}_{}'.format(data_file, features_fp[:16], data_fp[:16]))
+
+
+def prediction_fingerprint(data_path, model_fingerprint, *settings):
+	"""SHA-1 identifying the predictions for the file at `data_path` of the model with `model_fingerprint`, batched
+	with `settings`."""
+	sha = hashlib.sha1()
+	for part in [file_fingerprint(data_path), model_fingerprint] + [str(s) for s in settings]:
+		sha.update(part.encode('utf-8'))
+		sha.update(b'\0')
+	return sha.hexdigest()
+
+
+def features_to_arrays(features, max_seq_length):
+	"""Converts a list of `InputFeatures` padded to `max_seq_length` into one int64 array per column of
+	`FEATURE_ARRAYS`."""
+	shape = (len(features), max_seq_length)
+	return [
+		np.array([f.input_ids for f in features], dtype=np.int64).reshape(shape),
+		np.array([f.input_mask for f in features], dtype=np.int64).reshape(shape),
+		np.array([f.segment_ids for f in features], dtype=np.int64).reshape(shape),
+		np.array([f.label_id for f in features], dtype=np.int64),
+	]
+
+
+def feature_arrays_exist(cache_dir):
+	return all(os.path.exists(os.path.join(cache_dir, name + '.npy')) for name in FEATURE_ARRAYS)
+
+
+def save_feature_arrays(arrays, cache_dir):
+	"""Saves the feature arrays as `.npy` files in `cache_dir`."""
+	os.makedirs(cache_dir, exist_ok=True)
+	for name, array in zip(FEATURE_ARRAYS, arrays):
+		# Write then rename, so that an interrupted save never leaves a truncated array behind.
+		tmp_path = os.path.join(cache_dir, name + '.tmp.npy')
+		np.save(tmp_path, array)
+		os.replace(tmp_path, os.path.join(cache_dir, name + '.npy'))
+
+
+def remove_stale_feature_caches(cache_dir):
+	"""Removes the caches of older versions of the data file of `cache_dir` (see `feature_cache_dir`), i.e. those with
+	the same features fingerprint but another data fingerprint. The caches of other tokenizers or settings are kept.
+	Returns the removed directories."""
+	parent, name = os.path.split(cache_dir)
+	prefix = name.rsplit('_', 1)[0] + '_'
+	stale = re.compile(re.escape(prefix) + '[0-9a-f]{16}$')
+	removed = []
+	for sibling in os.listdir(parent or '.'):
+		path = os.path.join(parent, sibling)
+		if sibling != name and stale.match(sibling) and os.path.isdir(path):
+			shutil.rmtree(path, ignore_errors=True)
+			removed.append(path)
+	return removed
+
+
+def load_feature_arrays(cache_dir):
+	"""Memory-maps the feature arrays saved by `save_feature_arrays` (copy-on-write, nothing is read up front)."""
+	return [np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='c') for name in FEATURE_ARRAYS]
+
+
 def get_labels(model_version=2):
 	if model_version == 2:
 		return [-1, 0, 1, 2]
@@ -191,3 +434,68 @@ def format_score_sentence_output(bert_input, bert_output):
 			new_line = '\t'.join([label] + [s])
 			new_lines.append(new_line)
 		return new_lines
+
+
+def _trie_regex(phrases):
+	"""Regex matching any of `phrases`, with shared prefixes merged so that each character is tested once per position."""
+	trie = {}
+	for phrase in phrases:
+		node = trie
+		for char in phrase:
+			node = node.setdefault(char, {})
+		node[''] = {}
+
+	def to_regex(node):
+		# Longer phrases are tried before the ones that end here.
+		alternatives = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char]
+		if '' in node:
+			alternatives.append('')
+		if not alternatives:
+			return '(?!)'  # No phrases: never match.
+		if len(alternatives) == 1:
+			return alternatives[0]
+		return '(?:' + '|'.join(alternatives) + ')'
+
+	return re.compile(to_regex(trie))
+
+
+def read_demographics(demographics_file=DEMOGRAPHICS_FILE):
+	"""Demographic prefixes of the samples and their labels, e.g. `The Black person` -> `Black`."""
+	demographics = OrderedDict()
+	with open(demographics_file, 'r') as f:
+		for line in f:
+			prefix = line.strip()
+			if prefix:
+				label = prefix
+				if label.startswith('The '):
+					label = label[len('The '):]
+				if label.endswith(' person'):
+					label = label[:-len(' person')]
+				demographics[prefix] = label
+	return demographics
+
+
+class ContextMatcher(object):
+	"""Finds the demographic a sample starts with and the leftmost bias context phrase in it.
+
+	All demographic prefixes and all context phrases are compiled into one trie-shaped regex each, so a sample is
+	scanned once however many demographics and contexts there are.
+	"""
+
+	def __init__(self, contexts=CONTEXTS, demographics=None):
+		if demographics is None:
+			demographics = read_demographics()
+		self.demographics = demographics
+		self.context_categories = {phrase: category for category, phrases in contexts.items() for phrase in phrases}
+		self.demographic_regex = _trie_regex(demographics.keys())
+		self.context_regex = _trie_regex(self.context_categories.keys())
+
+	def match(self, s):
+		"""Returns (demographic, context phrase, context category) of s; each is None if not found."""
+		demographic = self.demographic_regex.match(s)
+		if demographic is not None:
+			demographic = self.demographics[demographic.group()]
+		context = self.context_regex.search(s)
+		if context is None:
+			return demographic, None, None
+		return demographic, context.group(), self.context_categories[context.group()]